@@ -0,0 +1,308 @@
+# coding=utf=8
+"""
+passes: parse counts and wall time of the build passes (get_ids, update_toc_dict,
+get_chapter_html) with every page parsed again in every pass, as the build used to,
+compared with pages parsed once and shared between the passes.
+render: wall time of rendering the whole book (all chapters by default)
+serially and in a process pool.
+ids: memory taken by the ids map of the whole book as plain dicts and as IdMaps.
+Pages are read from the page cache only, so run a build once first.
+freeze: copy the cached pages of the docs site into a snapshot directory.
+suite: wall time, peak RSS and parse counts of every build stage, with the
+pages served from the snapshot by a local HTTP stand-in (or as file:// urls),
+each stage in a fresh process with an empty page cache. Loading the data
+is measured from the json files and from the SQLite store built from them.
+Results can be saved as a baseline and compared with a later run.
+
+    python benchmark.py passes --chapters 6 7
+    python benchmark.py passes --parser-backend lxml --extract-backend selectolax
+    python benchmark.py render --processes 4
+    python benchmark.py ids
+    python benchmark.py freeze
+    python benchmark.py suite --save-baseline baseline.json
+    python benchmark.py suite --baseline baseline.json --file-root
+"""
+import argparse
+import functools
+import http.server
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from read_the_docs import Parser, PageCache, BuildStats, IdMap, CACHE_DIR, DOCS_MAIN_PAGE, TRANSFORM_BACKENDS, \
+    EXTRACT_BACKENDS, save_html
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is left out there
+    resource = None
+
+SNAPSHOT_DIR = Path(__file__).parent / 'snapshot'
+DATA_DIR = Path(__file__).parent / 'data'
+
+
+def clear_pages(parser: Parser) -> None:
+    # parsed_pages would otherwise hand the pages parsed before to the next pass by content
+    parser.pages.clear()
+    parser.parsed_pages.clear()
+
+
+def run_passes(parser: Parser, chapters: list, reuse_pages: bool) -> dict:
+    clear_pages(parser)
+    parser.stats = BuildStats()
+    parser.cache.stats = parser.stats
+    urls = {chapter: parser.urls[chapter] for chapter in chapters}
+    start = time.perf_counter()
+    parser.get_ids(urls)
+    for chapter_urls in urls.values():
+        if not reuse_pages:
+            clear_pages(parser)
+        for url in chapter_urls:
+            parser.update_toc_dict(url)
+    for chapter in chapters:
+        if not reuse_pages:
+            clear_pages(parser)
+        parser.get_chapter_html(chapter)
+    return {
+        'seconds': time.perf_counter() - start,
+        'pages parsed': parser.stats.counters['pages_parsed'],
+        'sections parsed': parser.stats.counters['sections_parsed']
+    }
+
+
+def run_render(parser: Parser, chapters: list, processes: int) -> float:
+    clear_pages(parser)
+    start = time.perf_counter()
+    for _ in parser.iter_full_html(chapters, processes):
+        pass
+    return time.perf_counter() - start
+
+
+def allocated_bytes(build) -> int:
+    # memory still taken by what build() returns, the url and old_id strings are shared and not counted
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def run_ids(parser: Parser, mapping_type) -> dict:
+    return {
+        'bytes': allocated_bytes(lambda: {chapter: {url: mapping_type(ids) for url, ids in urls.items()}
+                                          for chapter, urls in parser.ids.items()}),
+        'pages': sum(len(urls) for urls in parser.ids.values()),
+        'ids': sum(len(ids) for urls in parser.ids.values() for ids in urls.values())
+    }
+
+
+def freeze(cache_dir: Path, snapshot_dir: Path) -> int:
+    """
+    Write the body of every cached page of the docs site to snapshot_dir,
+    at its path below DOCS_MAIN_PAGE.
+    """
+    cache = PageCache(cache_dir, offline=True)
+    count = 0
+    for index_path in cache.index_dir.glob('*.json'):
+        entry = json.loads(index_path.read_text())
+        if not entry['url'].startswith(DOCS_MAIN_PAGE + '/'):
+            continue
+        path = snapshot_dir / entry['url'][len(DOCS_MAIN_PAGE) + 1:].split('#')[0]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes((cache.objects_dir / entry['sha256']).read_bytes())
+        count += 1
+    return count
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+
+def serve_snapshot(snapshot_dir: Path) -> http.server.ThreadingHTTPServer:
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             functools.partial(QuietHandler, directory=str(snapshot_dir)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def peak_rss_mb() -> float or None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_stage(stage: str, mirror: str, parser_backend: str, extract_backend: str or None) -> dict:
+    """
+    Run one stage of the build in this (fresh) process with an empty page cache,
+    pages being downloaded from mirror, and measure it.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = PageCache(Path(tmp_dir) / 'cache', mirror=mirror)
+        kwargs = dict(cache=cache, parser_backend=parser_backend, extract_backend=extract_backend)
+        if stage in ('Parser from json', 'Parser from store'):
+            data_dir = Path(tmp_dir) / 'data'
+            data_dir.mkdir()
+            for name in ('urls.json', 'ids.json', 'toc.json'):
+                shutil.copy(DATA_DIR / name, data_dir)
+            # reads the json files and builds data_dir/store.sqlite from them
+            parser = Parser(from_json=True, data_dir=data_dir, **kwargs)
+            start = time.perf_counter()
+            if stage == 'Parser from json':
+                parser.get_urls_from_json()
+                parser.get_ids_from_json()
+                parser.get_toc_from_json()
+            else:
+                parser = Parser(from_json=True, data_dir=data_dir, **kwargs)
+                parser.load_all_chapters()
+        else:
+            parser = Parser(from_json=True, **kwargs)
+            # only the stage itself is measured
+            parser.stats = BuildStats()
+            parser.cache.stats = parser.stats
+            start = time.perf_counter()
+        if stage == 'get_ids':
+            parser.get_ids(parser.urls)
+        elif stage == 'get_toc':
+            parser.load_all_chapters()
+            start = time.perf_counter()
+            parser.toc = dict()
+            parser.get_toc()
+        elif stage.startswith('get_chapter_html '):
+            parser.get_chapter_html(int(stage.split()[-1]))
+        elif stage == 'get_full_html one chapter':
+            parser.get_full_html()
+        elif stage == 'get_full_html all chapters':
+            parser.get_full_html(parser.chapters)
+        elif stage == 'save_html':
+            html = ''.join(parser.iter_full_html(parser.chapters))
+            start = time.perf_counter()
+            save_html(html, Path(tmp_dir) / 'content.html')
+        seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'peak rss MB': peak_rss_mb(),
+        'pages parsed': parser.stats.counters['pages_parsed'],
+        'sections parsed': parser.stats.counters['sections_parsed'],
+        'downloads': parser.stats.counters['downloads']
+    }
+
+
+def run_suite(mirror: str, chapters: list, repeat: int, parser_backend: str, extract_backend: str or None) -> dict:
+    stages = ['Parser from json', 'Parser from store', 'get_ids', 'get_toc']
+    stages += [f'get_chapter_html {chapter}' for chapter in chapters]
+    stages += ['get_full_html one chapter', 'get_full_html all chapters', 'save_html']
+    results = dict()
+    for stage in stages:
+        runs = list()
+        for _ in range(repeat):
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                runs.append(executor.submit(run_stage, stage, mirror, parser_backend, extract_backend).result())
+        result = runs[0]
+        result['seconds'] = statistics.median(run['seconds'] for run in runs)
+        results[stage] = result
+        print(f'{stage:30}{result["seconds"]:>10.3f} s', file=sys.stderr)
+    return results
+
+
+def print_suite(results: dict, baseline: dict or None) -> None:
+    header = f'{"stage":30}{"seconds":>10}{"peak MB":>10}{"pages":>8}{"sections":>10}'
+    print(header + (f'{"baseline":>10}{"change":>9}' if baseline else ''))
+    for stage, result in results.items():
+        rss = result['peak rss MB']
+        line = (f'{stage:30}{result["seconds"]:>10.3f}{rss if rss is None else round(rss, 1):>10}'
+                f'{result["pages parsed"]:>8}{result["sections parsed"]:>10}')
+        if baseline and stage in baseline:
+            before = baseline[stage]['seconds']
+            line += f'{before:>10.3f}{(result["seconds"] - before) / before:>+9.1%}'
+        print(line)
+
+
+def print_table(before: dict, after: dict, labels=('before', 'after')) -> None:
+    print(f'{"":20}{labels[0]:>12}{labels[1]:>12}')
+    for key in before:
+        print(f'{key:20}{before[key]:>12.3f}{after[key]:>12.3f}'
+              if isinstance(before[key], float) else f'{key:20}{before[key]:>12}{after[key]:>12}')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('benchmark', choices=('passes', 'render', 'ids', 'freeze', 'suite'), nargs='?',
+                            default='passes')
+    arg_parser.add_argument('--chapters', type=int, nargs='+')
+    arg_parser.add_argument('--processes', type=int, default=os.cpu_count())
+    arg_parser.add_argument('--cache-dir', default=CACHE_DIR)
+    arg_parser.add_argument('--parser-backend', choices=TRANSFORM_BACKENDS, default='html.parser')
+    arg_parser.add_argument('--extract-backend', choices=EXTRACT_BACKENDS)
+    arg_parser.add_argument('--snapshot', type=Path, default=SNAPSHOT_DIR)
+    arg_parser.add_argument('--file-root', action='store_true',
+                            help='read the snapshot through file:// urls instead of a local HTTP server')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the median time is reported')
+    arg_parser.add_argument('--baseline', type=Path, help='compare with the results saved in this file')
+    arg_parser.add_argument('--save-baseline', type=Path, help='save the results to this file')
+    args = arg_parser.parse_args()
+
+    if args.benchmark == 'freeze':
+        print(f'{freeze(Path(args.cache_dir), args.snapshot)} pages written to {args.snapshot}')
+        return
+    if args.benchmark == 'suite':
+        if not (args.snapshot / 'index.html').exists():
+            arg_parser.error(f'no snapshot in {args.snapshot}, run "python benchmark.py freeze" first')
+        server = None
+        if args.file_root:
+            mirror = args.snapshot.resolve().as_uri()
+        else:
+            server = serve_snapshot(args.snapshot)
+            mirror = f'http://127.0.0.1:{server.server_address[1]}'
+        chapters = args.chapters or Parser(from_json=True, cache=PageCache(args.cache_dir, offline=True)).chapters
+        try:
+            results = run_suite(mirror, chapters, args.repeat, args.parser_backend, args.extract_backend)
+        finally:
+            if server:
+                server.shutdown()
+        baseline = json.loads(args.baseline.read_text())['stages'] if args.baseline else None
+        print_suite(results, baseline)
+        if args.save_baseline:
+            args.save_baseline.write_text(json.dumps({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'parser_backend': args.parser_backend,
+                'extract_backend': args.extract_backend,
+                'stages': results
+            }, indent=2))
+        return
+
+    # without memoized fragments, which would skip the work being measured
+    parser = Parser(from_json=True, cache=PageCache(args.cache_dir, offline=True), memoize=False,
+                    parser_backend=args.parser_backend, extract_backend=args.extract_backend)
+    parser.load_all_chapters()
+    if args.benchmark == 'passes':
+        chapters = args.chapters or [6]
+        print_table(run_passes(parser, chapters, reuse_pages=False), run_passes(parser, chapters, reuse_pages=True),
+                    ('every pass', 'once'))
+    elif args.benchmark == 'ids':
+        print_table(run_ids(parser, dict), run_ids(parser, IdMap), ('dict', 'IdMap'))
+    else:
+        chapters = args.chapters or parser.chapters
+        serial = run_render(parser, chapters, 1)
+        parallel = run_render(parser, chapters, args.processes)
+        print(f'{len(chapters)} chapters')
+        print(f'{"1 process":20}{serial:>12.3f}')
+        print(f'{f"{args.processes} processes":20}{parallel:>12.3f}')
+        print(f'{"speedup":20}{serial / parallel:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
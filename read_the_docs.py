@@ -1,20 +1,164 @@
 # coding=utf=8
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Comment, NavigableString
+from bs4.builder import builder_registry
 import urllib.request
 import urllib.parse
+import urllib.error
 # import requests
 # url = ''
 # r = requests.get(url)
 # r.text
 from w3lib.url import safe_url_string
+import argparse
+import asyncio
+import base64
+import bisect
+import contextlib
+import cProfile
+import gzip
 import logging
+import math
+import mimetypes
 import os
+import pstats
 import json
+import re
+import hashlib
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+import zlib
+from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+# pdf export
+try:
+    import weasyprint
+except ImportError:
+    weasyprint = None
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
 
 DOCS_MAIN_PAGE \
     = 'https://edx.readthedocs.io/projects/open-edx-building-and-running-a-course/en/open-release-nutmeg.master'
 DOCS_TOC_PAGE = DOCS_MAIN_PAGE + '/index.html'
+# the title of the book when the main page has none
+DOCS_TITLE = 'Building and Running an Open edX Course: Nutmeg Release'
+# memoized fragments are transformed as if the site were here, so that identical pages
+# of several sites share them, the site's main page url is put back when they are used
+FRAGMENT_MAIN_PAGE = 'https://main-page.invalid'
+CACHE_DIR = Path(__file__).parent / 'cache'
+# revalidation is mostly waiting for 304 responses, so it uses at least this many threads
+REVALIDATE_WORKERS = 8
+# bump whenever the layout of the SQLite data store changes
+STORE_VERSION = 4
+# bump whenever rewrite_section gives a different result, so memoized fragments are not reused
+TRANSFORM_VERSION = 1
+# bump whenever the layout of the crawl checkpoint changes, older checkpoints are then ignored
+CHECKPOINT_VERSION = 1
+# BeautifulSoup tree builders usable for the transformation pipeline,
+# the read-only extraction steps can additionally use selectolax
+TRANSFORM_BACKENDS = ('html.parser', 'lxml')
+EXTRACT_BACKENDS = TRANSFORM_BACKENDS + ('selectolax',)
+
+# the page of Parser.save_chapters that loads the chapters listed in manifest.json on demand
+READER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="style.css">
+</head>
+<body>
+<nav id="toc"></nav>
+<main id="content"></main>
+<script>
+let manifest = null;
+let shown = null;
+
+async function load(file) {
+  const text = await (await fetch(file)).text();
+  const body = new DOMParser().parseFromString(text, 'text/html').body;
+  // stay in the reader when following links to other chapters
+  body.querySelectorAll('a[href*="#"]').forEach(
+    a => a.setAttribute('href', a.getAttribute('href').replace(/^[^#]*/, '')));
+  return body.childNodes;
+}
+
+async function show() {
+  const anchor = decodeURIComponent(location.hash.slice(1));
+  const chapter = manifest.ids[anchor] || manifest.chapters[0].chapter;
+  if (chapter !== shown) {
+    const entry = manifest.chapters.find(c => c.chapter === chapter) || manifest.chapters[0];
+    document.getElementById('content').replaceChildren(...await load(entry.file));
+    shown = entry.chapter;
+  }
+  const target = anchor && document.getElementById(anchor);
+  if (target) target.scrollIntoView();
+}
+
+(async () => {
+  manifest = await (await fetch('manifest.json')).json();
+  document.getElementById('toc').replaceChildren(...await load(manifest.index));
+  window.addEventListener('hashchange', show);
+  show();
+})();
+</script>
+</body>
+</html>
+"""
+
+EPUB_CONTAINER_XML = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+EPUB_PACKAGE_OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package version="3.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="book-id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">urn:uuid:{identifier}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>en</dc:language>
+    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>
+    {manifest}
+  </manifest>
+  <spine>
+    {spine}
+  </spine>
+</package>
+"""
+# page and nav documents of Parser.export_epub
+EPUB_PAGE_XHTML = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en">
+<head>
+<meta charset="utf-8"/>
+<title>{title}</title>
+<link rel="stylesheet" href="{css}"/>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
 
 # _logger = logging.getLogger(f'{__name__}: ')
 # _logger.setLevel(logging.DEBUG)
@@ -41,6 +185,51 @@ def _json_loads_tuple_keys(string: str) -> dict:
     return {tuple(json.loads(k)): v for k, v in mapping.items()}
 
 
+def _json_loads_none_key(ids: dict) -> dict:
+    # json.dump writes the None old_id (of toc entries without an anchor) as 'null'
+    return {None if old_id == 'null' else old_id: new_id for old_id, new_id in ids.items()}
+
+
+def _pack_toc_key(key_idx: tuple) -> bytes:
+    # 4 big-endian bytes per section number, so the blobs sort like the tuples
+    return struct.pack(f'>{len(key_idx)}I', *key_idx)
+
+
+def _unpack_toc_key(key: bytes) -> tuple:
+    return struct.unpack(f'>{len(key) // 4}I', key)
+
+
+def _check_backend(backend: str, allowed: tuple) -> str:
+    if backend not in allowed:
+        raise ValueError(f'unknown parser backend {backend!r}, use one of {allowed}')
+    if backend == 'selectolax':
+        if LexborHTMLParser is None:
+            raise ImportError('the selectolax backend needs the selectolax package')
+    elif builder_registry.lookup(backend) is None:
+        raise ImportError(f'the {backend} backend is not installed')
+    return backend
+
+
+def _file_size(path: Path) -> int or None:
+    # None for a file another process sharing the cache directory has just evicted
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return None
+
+
+def _file_mtime(path: Path) -> float or None:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _check_pdf_support() -> None:
+    if weasyprint is None or pypdf is None:
+        raise ImportError('the pdf export needs the weasyprint and pypdf packages')
+
+
 def parse_href(href: str) -> (str, str, str):
     """
     parse_href('aaa/bbb.html#cc-ddd')
@@ -59,6 +248,58 @@ def parse_href(href: str) -> (str, str, str):
     return filename, old_id, new_id
 
 
+def _toc_new_id(filename: str, old_id: str or None) -> str:
+    return f'{filename.split(".")[0].replace("/", "-")}{"-" + old_id if old_id else ""}'
+
+
+def _toc_link(link_kind: str, filename: str, old_id: str or None, main_page_url=DOCS_MAIN_PAGE) -> str:
+    # 'url' entries come from the main page TOC, 'href' ones from update_toc_dict
+    if link_kind == 'href':
+        return f"{main_page_url}/{filename}#{old_id}"
+    return f"{main_page_url}/{filename}{'#' + old_id if old_id else ''}"
+
+
+def target_name(main_page_url: str) -> str:
+    """
+    Short name of a docs site for file names, e.g.
+    open-edx-learner-guide-open-release-olive.master for
+    https://edx.readthedocs.io/projects/open-edx-learner-guide/en/open-release-olive.master
+    """
+    parts = urllib.parse.urlsplit(main_page_url).path.strip('/').split('/')
+    return '-'.join(part for part in parts if part not in ('projects', 'en'))
+
+
+def parse_inventory(data: bytes) -> list:
+    """
+    (name, domain:role, uri, display name) of every object of a Sphinx objects.inv
+    (version 2), uri relative to the docs root, e.g.
+    ('set_up_course/index', 'std:doc', 'set_up_course/index.html', 'Setting Up a Course')
+    """
+    lines = data.split(b'\n', 4)
+    if len(lines) < 5 or lines[0].rstrip() != b'# Sphinx inventory version 2':
+        raise ValueError(f'not a version 2 Sphinx inventory: {lines[0][:50]}')
+    objects = list()
+    for line in zlib.decompress(lines[4]).decode().splitlines():
+        match = re.match(r'(.+?)\s+(\S+)\s+(-?\d+)\s+?(\S*)\s+(.*)', line.rstrip())
+        if not match:
+            continue
+        name, role, _, uri, display_name = match.groups()
+        if uri.endswith('$'):
+            uri = uri[:-1] + name
+        objects.append((name, role, uri, name if display_name == '-' else display_name))
+    return objects
+
+
+def parse_sitemap(data: bytes) -> dict:
+    """{loc: lastmod or None} of a sitemap.xml urlset"""
+    lastmods = dict()
+    for url in ElementTree.fromstring(data):
+        fields = {field.tag.split('}')[-1]: (field.text or '').strip() for field in url}
+        if fields.get('loc'):
+            lastmods[fields['loc']] = fields.get('lastmod') or None
+    return lastmods
+
+
 def make_hrefs_absolute(toc_dict: dict) -> dict:
     for k, v in toc_dict.items():
         if not v['href'].startswith('https'):
@@ -66,104 +307,1448 @@ def make_hrefs_absolute(toc_dict: dict) -> dict:
     return toc_dict
 
 
+class BuildStats:
+    """
+    Wall time per build stage and counters (bytes fetched, cache hits,
+    pages parsed, nodes visited, ids rewritten...), optionally with a cProfile
+    profile and the tracemalloc peak of everything after construction.
+    Stage times are inclusive and summed over threads.
+    """
+    def __init__(self, profile=False, trace_memory=False):
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getstate__(self) -> dict:
+        # a copy in another process starts from zero
+        return dict()
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.timings[name] += time.perf_counter() - start
+                self.calls[name] += 1
+
+    def count(self, name: str, n=1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def merge(self, report: dict) -> None:
+        with self._lock:
+            for name, timing in report['timings'].items():
+                self.timings[name] += timing['seconds']
+                self.calls[name] += timing['calls']
+            for name, n in report['counters'].items():
+                self.counters[name] += n
+
+    def report(self, top_functions=30) -> dict:
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'timings': {name: {'seconds': round(self.timings[name], 6), 'calls': self.calls[name]}
+                        for name in sorted(self.timings)},
+            'counters': dict(sorted(self.counters.items()))
+        }
+        if self.trace_memory:
+            report['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        if self.profiler:
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler).stats
+            functions = sorted(stats.items(), key=lambda x: x[1][3], reverse=True)[:top_functions]
+            report['profile'] = [
+                {'function': f'{filename}:{line}({name})', 'calls': calls, 'own_seconds': round(own, 6),
+                 'cumulative_seconds': round(cumulative, 6)}
+                for (filename, line, name), (_, calls, own, cumulative, _) in functions
+            ]
+            self.profiler.enable()
+        return report
+
+
+class HostRateLimiter:
+    """
+    Spaces out requests to the same host by at least min_interval seconds,
+    no matter how many threads are fetching.
+    """
+    def __init__(self, min_interval=0.0):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = dict()
+
+    def __getstate__(self) -> dict:
+        # locks cannot be pickled, every process gets its own limiter
+        return {'min_interval': self.min_interval}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['min_interval'])
+
+    def wait(self, url: str) -> None:
+        if not self.min_interval:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class PageCache:
+    """
+    Content-addressed on-disk cache for fetched pages.
+    cache_dir/objects/<sha256 of body> holds every distinct body once,
+    cache_dir/index/<sha256 of url>.json maps a url to its body hash
+    and the ETag / Last-Modified validators it was served with.
+    Index files' mtime is the last access time used for LRU eviction.
+    Downloads are retried with exponential backoff and rate limited per host;
+    mirror replaces the DOCS_MAIN_PAGE prefix of requested urls (e.g. with
+    a local stand-in server) while entries stay keyed by the original url,
+    a {prefix: replacement} dict does the same for several docs sites.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_size=512 * 2 ** 20, offline=False, revalidate=False,
+                 retries=3, backoff=0.5, min_interval=0.0, timeout=30, mirror=None):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / 'objects'
+        self.index_dir = self.cache_dir / 'index'
+        self.max_size = max_size
+        self.offline = offline
+        self.revalidate = revalidate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.mirror = {DOCS_MAIN_PAGE: mirror} if isinstance(mirror, str) else mirror or dict()
+        self.rate_limiter = HostRateLimiter(min_interval)
+        self.stats = BuildStats()
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        # urls already revalidated during this run
+        self._fresh = set()
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes) -> None:
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _index_path(self, url: str) -> Path:
+        return self.index_dir / f'{hashlib.sha256(url.encode()).hexdigest()}.json'
+
+    def get_entry(self, url: str) -> dict or None:
+        try:
+            with open(self._index_path(url)) as infile:
+                entry = json.load(infile)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not (self.objects_dir / entry['sha256']).exists():
+            return None
+        return entry
+
+    def get_object(self, sha256: str) -> bytes or None:
+        try:
+            return (self.objects_dir / sha256).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def mark_fresh(self, urls) -> None:
+        # known to be unchanged, so served from the cache even with revalidate on
+        self._fresh.update(urls)
+
+    def _read_body(self, entry: dict, url: str) -> bytes:
+        os.utime(self._index_path(url))
+        return (self.objects_dir / entry['sha256']).read_bytes()
+
+    def put(self, url: str, body: bytes, etag=None, last_modified=None) -> dict:
+        digest = hashlib.sha256(body).hexdigest()
+        object_path = self.objects_dir / digest
+        with self._lock:
+            if not object_path.exists():
+                self._write_atomic(object_path, body)
+                if self._size is not None:
+                    self._size += len(body)
+            entry = {
+                'url': url,
+                'sha256': digest,
+                'size': len(body),
+                'etag': etag,
+                'last_modified': last_modified,
+                'fetched': time.time()
+            }
+            self._write_atomic(self._index_path(url), json.dumps(entry).encode())
+            self.evict()
+        return entry
+
+    def get(self, url: str) -> bytes:
+        entry = self.get_entry(url)
+        if entry and (url in self._fresh or not self.revalidate or self.offline):
+            self.stats.count('cache_hits')
+            return self._read_body(entry, url)
+        if self.offline:
+            raise FileNotFoundError(f'{url} is not cached and offline mode is on')
+
+        headers = dict()
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            body, response_headers = self._download(url, headers)
+        except urllib.error.HTTPError as exc:
+            if exc.code == 304 and entry:
+                self.stats.count('not_modified')
+                self._fresh.add(url)
+                return self._read_body(entry, url)
+            raise
+        self.stats.count('downloads')
+        self.stats.count('bytes_fetched', len(body))
+        self.put(url, body, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+        self._fresh.add(url)
+        return body
+
+    def _download(self, url: str, headers: dict) -> (bytes, dict):
+        for prefix, replacement in self.mirror.items():
+            if url.startswith(prefix):
+                url = replacement + url[len(prefix):]
+                break
+        request = urllib.request.Request(_iri_to_uri(url), headers=headers)
+        attempt = 0
+        while True:
+            self.rate_limiter.wait(url)
+            try:
+                with self.stats.stage('fetch'), urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return response.read(), response.headers
+            except urllib.error.HTTPError as exc:
+                if exc.code not in (429, 500, 502, 503, 504) or attempt >= self.retries:
+                    raise
+            except (urllib.error.URLError, TimeoutError, ConnectionError):
+                if attempt >= self.retries:
+                    raise
+            delay = self.backoff * 2 ** attempt
+            _logger.warning('retrying %s in %.1fs', url, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = sum(_file_size(p) or 0 for p in self.objects_dir.iterdir() if not p.name.startswith('.'))
+        return self._size
+
+    def evict(self) -> None:
+        if self.size() <= self.max_size:
+            return
+        # other processes may evict from the same directory, what they removed meanwhile is skipped
+        mtimes = {path: _file_mtime(path) for path in self.index_dir.glob('*.json')}
+        referenced = dict()
+        for path in sorted((p for p in mtimes if mtimes[p] is not None), key=mtimes.get):
+            try:
+                with open(path) as infile:
+                    referenced[path] = json.load(infile)['sha256']
+            except (FileNotFoundError, ValueError):
+                continue
+        for path in list(referenced):
+            if self._size <= self.max_size:
+                break
+            digest = referenced.pop(path)
+            path.unlink(missing_ok=True)
+            if digest not in referenced.values():
+                object_path = self.objects_dir / digest
+                size = _file_size(object_path)
+                if size is None:
+                    # another process is evicting too, measure again what is left
+                    self._size = None
+                    self.size()
+                    continue
+                self._size -= size
+                object_path.unlink(missing_ok=True)
+
+
+class FragmentCache:
+    """
+    Transformed sections on disk, cache_dir/<key>.html, keyed by a hash of
+    everything the transformation depends on (see Parser.fragment_key).
+    A file's mtime is its last access time, the least recently used fragments
+    are evicted once their total size exceeds max_size.
+    """
+    def __init__(self, cache_dir=CACHE_DIR / 'fragments', max_size=128 * 2 ** 20):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str or None:
+        path = self.cache_dir / f'{key}.html'
+        try:
+            html = path.read_text(encoding='utf-8')
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return html
+
+    def __contains__(self, key: str) -> bool:
+        return (self.cache_dir / f'{key}.html').exists()
+
+    def put(self, key: str, html: str) -> None:
+        path = self.cache_dir / f'{key}.html'
+        data = html.encode('utf-8')
+        with self._lock:
+            if path.exists():
+                return
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            PageCache._write_atomic(path, data)
+            if self._size is not None:
+                self._size += len(data)
+            self.evict()
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = sum(_file_size(p) or 0 for p in self.cache_dir.glob('*.html'))
+        return self._size
+
+    def evict(self) -> None:
+        if self.size() <= self.max_size:
+            return
+        # other processes may evict from the same directory, what they removed meanwhile is skipped
+        mtimes = {path: _file_mtime(path) for path in self.cache_dir.glob('*.html')}
+        for path in sorted((p for p in mtimes if mtimes[p] is not None), key=mtimes.get):
+            if self._size <= self.max_size:
+                break
+            size = _file_size(path)
+            if size is None:
+                # another process is evicting too, measure again what is left
+                self._size = None
+                self.size()
+                continue
+            self._size -= size
+            path.unlink(missing_ok=True)
+
+
+def _get_id_and_title_from_ascendant_section(t: BeautifulSoup) -> (str, str or None):
+    p = t.parent
+    while True:
+        if p.name == 'section' and p.attrs.get('id'):
+            tid = p.attrs.get('id')
+            break
+        p = p.parent
+    p = t.parent
+    title_l = [x.strip(' \n') for x in p.contents if not x.name]
+    title_l = [x for x in title_l if x]
+    if title_l:
+        ttl = title_l[0]
+    else:
+        try:
+            ttl = str(p.find('code').find('span').string)
+        except AttributeError:
+            _logger.error(f"tag: {t}")
+            _logger.error(f"parent: {p}")
+            ttl = None
+    return tid, ttl
+
+
+def _get_id_and_title_from_ascendant_lexbor_section(t) -> (str, str or None):
+    # same as _get_id_and_title_from_ascendant_section for a selectolax node
+    p = t.parent
+    while True:
+        if p.tag == 'section' and p.attributes.get('id'):
+            tid = p.attributes.get('id')
+            break
+        p = p.parent
+    p = t.parent
+    title_l = [x.text(deep=False).strip(' \n') for x in p.iter(include_text=True) if x.tag == '-text']
+    title_l = [x for x in title_l if x]
+    if title_l:
+        ttl = title_l[0]
+    else:
+        code = p.css_first('code')
+        span = code.css_first('span') if code else None
+        if span is None:
+            _logger.error(f"tag: {t.html}")
+            _logger.error(f"parent: {p.html}")
+        ttl = span.text() if span else None
+    return tid, ttl
+
+
+def _get_menu_links_from_soup(soup: BeautifulSoup) -> list:
+    content = soup.find_all('div', {"class": 'wy-menu wy-menu-vertical'})[0]
+    toc = content.find('ul')
+    lis = toc.find_all('li')
+    links = list()
+    for li in lis:
+        a_tag = li.find_all('a')
+        for i in a_tag:
+            contents = [x for x in i.contents if not x.name][0]
+            links.append((str(contents), i.get('href')))
+    return links
+
+
+def _get_menu_links_from_lexbor(tree) -> list:
+    content = tree.css('div[class="wy-menu wy-menu-vertical"]')[0]
+    toc = content.css_first('ul')
+    links = list()
+    for li in toc.css('li'):
+        for i in li.css('a'):
+            contents = [x.text(deep=False) for x in i.iter(include_text=True) if x.tag == '-text'][0]
+            links.append((contents, i.attributes.get('href')))
+    return links
+
+
+class IdMap(MutableMapping):
+    """
+    The {old_id: new_id} map of one page. Nearly every new_id is the page's
+    base id (the value of the '' key) followed by '-<old_id>', so those are
+    kept as None and derived on lookup; only the few other ones
+    (from the main page TOC) are kept as strings.
+    """
+    __slots__ = ('_ids', '_base')
+
+    def __init__(self, items=()):
+        # {old_id: new_id, or None when it is derived from the base}, in insertion order
+        self._ids = dict()
+        self._base = None
+        if items:
+            self.update(items)
+
+    def _derive(self, old_id: str or None) -> str:
+        return f'{self._base}{f"-{old_id}" if old_id else ""}'
+
+    def __getitem__(self, old_id: str or None) -> str:
+        new_id = self._ids[old_id]
+        return self._derive(old_id) if new_id is None else new_id
+
+    def __setitem__(self, old_id: str or None, new_id: str) -> None:
+        if old_id == '':
+            if new_id != self._base:
+                # the derived new_ids would change with the base, keep them as they are
+                if self._base is not None:
+                    self._ids = {k: self[k] if k != '' else None for k in self._ids}
+                self._base = new_id
+                self._ids = {k: None if v == self._derive(k) else v for k, v in self._ids.items()}
+            self._ids[''] = None
+        elif self._base is not None and new_id == self._derive(old_id):
+            self._ids[old_id] = None
+        else:
+            self._ids[old_id] = new_id
+
+    def add_derived(self, old_id: str or None) -> None:
+        # old_id whose new_id is '<base>-<old_id>', without building it to compare (see Parser.get_from_store)
+        self._ids[old_id] = None
+
+    def __delitem__(self, old_id: str or None) -> None:
+        if old_id == '' and '' in self._ids:
+            self._ids = {k: self[k] for k in self._ids}
+            self._base = None
+        del self._ids[old_id]
+
+    def __contains__(self, old_id) -> bool:
+        return old_id in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __repr__(self) -> str:
+        return f'IdMap({dict(self)!r})'
+
+
+class PageArtifacts:
+    """
+    Everything the build needs from one source page, extracted in one go:
+    ids - every id found on the page, in document order,
+    toc_entries - (key_idx, old_id, title) for every numbered section,
+    section_html - the content section, serialized; None when the page was
+    read with selectolax, whose serialization differs from BeautifulSoup.
+    No reference to the parsed tree is kept.
+    """
+    def __init__(self, ids: list, toc_entries: list, section_html: str or None):
+        self.ids = ids
+        self.toc_entries = toc_entries
+        self.section_html = section_html
+
+    @classmethod
+    def from_soup(cls, soup: BeautifulSoup) -> 'PageArtifacts':
+        ids = [tag.attrs.get('id') for tag in soup.find_all(lambda t: t.has_attr('id'))]
+        sections = soup.find_all('section')
+        section = [s for s in sections if s.attrs.get('id')][0]
+        # get ids from class='session-number'
+        toc_entries = list()
+        for tag in section.find_all(class_='section-number'):
+            key_idx = tuple(map(int, tag.string.strip('. ').split('.')))
+            old_id, title = _get_id_and_title_from_ascendant_section(tag)
+            toc_entries.append((key_idx, old_id, title))
+        return cls(ids, toc_entries, str(section))
+
+    @classmethod
+    def from_lexbor(cls, tree) -> 'PageArtifacts':
+        ids = [node.attributes.get('id') for node in tree.css('[id]')]
+        section = [s for s in tree.css('section') if s.attributes.get('id')][0]
+        toc_entries = list()
+        for tag in section.css('.section-number'):
+            key_idx = tuple(map(int, tag.text().strip('. ').split('.')))
+            old_id, title = _get_id_and_title_from_ascendant_lexbor_section(tag)
+            toc_entries.append((key_idx, old_id, title))
+        return cls(ids, toc_entries, None)
+
+
+class TocIndex:
+    """
+    The section numbers of a toc dict, sorted once. Every chapter or section
+    with its subsections is a contiguous run of the sorted tuples,
+    so range queries are two bisections.
+    """
+    def __init__(self, toc: dict):
+        self.toc = toc
+        self.size = len(toc)
+        self.keys = sorted(toc)
+        self._by_new_id = dict()
+        for key_idx in self.keys:
+            self._by_new_id.setdefault(toc[key_idx]['new_id'], key_idx)
+        self._by_depth = dict()
+
+    def is_current(self, toc: dict) -> bool:
+        # toc entries are only ever added, a new dict or a new size means a stale index
+        return toc is self.toc and len(toc) == self.size
+
+    def section(self, prefix: tuple) -> list:
+        """prefix itself (if in the toc) and all its subsections, sorted"""
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix[:-1] + (prefix[-1] + 1,), start)
+        return self.keys[start:end]
+
+    def chapter(self, chapter: int) -> list:
+        return self.section((chapter,))
+
+    def chapters(self) -> list:
+        chapters = list()
+        i = 0
+        while i < len(self.keys):
+            chapters.append(self.keys[i][0])
+            i = bisect.bisect_left(self.keys, (self.keys[i][0] + 1,), i)
+        return chapters
+
+    def up_to_depth(self, depth: int) -> list:
+        if depth not in self._by_depth:
+            self._by_depth[depth] = [k for k in self.keys if len(k) <= depth]
+        return self._by_depth[depth]
+
+    def parent(self, key_idx: tuple) -> tuple or None:
+        while len(key_idx) > 1:
+            key_idx = key_idx[:-1]
+            if key_idx in self.toc:
+                return key_idx
+        return None
+
+    def children(self, key_idx: tuple) -> list:
+        return [k for k in self.section(key_idx)[1:] if self.parent(k) == key_idx]
+
+    def find_new_id(self, new_id: str) -> tuple or None:
+        return self._by_new_id.get(new_id)
+
+
+class SearchIndex:
+    """
+    Inverted index of the book's text: token -> [anchor, position, anchor, position, ...],
+    where anchor is the number of the innermost section with an id (its new_id) the text is in
+    and position counts the tokens of that section, so that phrases can be matched.
+    Saved as gzipped json: meta.json.gz with the anchors and one shard per token hash bucket,
+    which a loaded index reads only when one of its tokens is queried.
+    """
+    VERSION = 1
+    SHARDS = 64
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory else None
+        # [new_id, title] of every indexed section
+        self.anchors = list()
+        self.postings = defaultdict(list)
+        self._anchor_idxs = dict()
+        self._lengths = list()
+        # shards read so far by a loaded index, None while building
+        self._loaded_shards = None
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        return re.findall(r'\w+', text.lower())
+
+    @classmethod
+    def get_shard(cls, token: str) -> int:
+        return zlib.crc32(token.encode()) % cls.SHARDS
+
+    def _get_anchor(self, new_id: str, title: str) -> int:
+        if new_id not in self._anchor_idxs:
+            self._anchor_idxs[new_id] = len(self.anchors)
+            self.anchors.append([new_id, title])
+            self._lengths.append(0)
+        return self._anchor_idxs[new_id]
+
+    def _add_text(self, anchor: int, text: str) -> int:
+        tokens = self.tokenize(text)
+        position = self._lengths[anchor]
+        for i, token in enumerate(tokens):
+            self.postings[token].extend((anchor, position + i))
+        self._lengths[anchor] += len(tokens)
+        return len(tokens)
+
+    def add(self, soup: BeautifulSoup) -> int:
+        """
+        Index the text of every section with an id in soup, return the number of tokens.
+        """
+        count = 0
+        stack = [(soup, None)]
+        while stack:
+            tag, anchor = stack.pop()
+            if isinstance(tag, NavigableString):
+                if anchor is not None and not isinstance(tag, Comment):
+                    count += self._add_text(anchor, str(tag))
+                continue
+            if tag.name in ('script', 'style'):
+                continue
+            if tag.name == 'section' and tag.get('id'):
+                heading = tag.find(re.compile('^h[1-6]$'))
+                title = heading.get_text(' ', strip=True).rstrip('\u00b6').strip() if heading else ''
+                anchor = self._get_anchor(tag['id'], title)
+            stack.extend((child, anchor) for child in reversed(tag.contents))
+        return count
+
+    def merge(self, other: 'SearchIndex') -> None:
+        # the sections of other follow the ones with the same new_id here
+        remap = list()
+        for (new_id, title), length in zip(other.anchors, other._lengths):
+            anchor = self._get_anchor(new_id, title)
+            remap.append((anchor, self._lengths[anchor]))
+            self._lengths[anchor] += length
+        for token, postings in other.postings.items():
+            merged = self.postings[token]
+            for i in range(0, len(postings), 2):
+                anchor, offset = remap[postings[i]]
+                merged.extend((anchor, offset + postings[i + 1]))
+
+    def save(self, directory=None) -> None:
+        directory = Path(directory or self.directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        shards = [dict() for _ in range(self.SHARDS)]
+        for token, postings in self.postings.items():
+            shards[self.get_shard(token)][token] = postings
+        meta = {'version': self.VERSION, 'shards': self.SHARDS, 'anchors': self.anchors}
+        for name, data in [('meta', meta)] + [(str(i), shard) for i, shard in enumerate(shards)]:
+            PageCache._write_atomic(directory / f'{name}.json.gz',
+                                    gzip.compress(json.dumps(data, separators=(',', ':')).encode()))
+
+    @classmethod
+    def load(cls, directory) -> 'SearchIndex':
+        index = cls(directory)
+        meta = json.loads(gzip.decompress((index.directory / 'meta.json.gz').read_bytes()))
+        if meta['version'] != cls.VERSION or meta['shards'] != cls.SHARDS:
+            raise ValueError(f'{directory} holds a search index of another version, rebuild it')
+        index.anchors = meta['anchors']
+        index._loaded_shards = set()
+        return index
+
+    def get_postings(self, token: str) -> list:
+        if self._loaded_shards is not None:
+            shard = self.get_shard(token)
+            if shard not in self._loaded_shards:
+                self._loaded_shards.add(shard)
+                self.postings.update(json.loads(gzip.decompress((self.directory / f'{shard}.json.gz').read_bytes())))
+        return self.postings.get(token, list())
+
+    def search(self, query: str, limit=10) -> list:
+        """
+        [(new_id, title, score)] of the sections containing every token of query,
+        or the exact phrase if query is in double quotes, best first.
+        """
+        phrase = len(query) > 1 and query.startswith('"') and query.endswith('"')
+        tokens = self.tokenize(query)
+        if not tokens:
+            return list()
+        # [{anchor: positions}] for every token
+        positions = list()
+        for token in tokens:
+            token_positions = defaultdict(set)
+            postings = self.get_postings(token)
+            for i in range(0, len(postings), 2):
+                token_positions[postings[i]].add(postings[i + 1])
+            positions.append(token_positions)
+        scores = dict()
+        for anchor in set(positions[0]).intersection(*positions[1:]):
+            if phrase:
+                score = sum(1 for start in positions[0][anchor]
+                            if all(start + i in positions[i][anchor] for i in range(1, len(tokens))))
+            else:
+                score = sum(len(token_positions[anchor]) for token_positions in positions)
+            if score:
+                scores[anchor] = score
+        best = sorted(scores, key=lambda anchor: (-scores[anchor], anchor))[:limit]
+        return [(self.anchors[anchor][0], self.anchors[anchor][1], scores[anchor]) for anchor in best]
+
+
+class LinkChecker:
+    """
+    The ids emitted into the book and the '#id' links pointing to them,
+    collected in one pass over every rendered chapter and checked
+    with set lookups once the book is done.
+    """
+    def __init__(self):
+        self.ids = set()
+        # {chapter: {target id: number of links}}
+        self.links = dict()
+
+    def add_chapter(self, chapter: int, *soups: BeautifulSoup) -> int:
+        links = self.links.setdefault(chapter, defaultdict(int))
+        count = 0
+        for soup in soups:
+            for tag in soup.find_all(True):
+                tag_id = tag.attrs.get('id')
+                if tag_id:
+                    self.ids.add(tag_id)
+                href = tag.attrs.get('href')
+                if href and href.startswith('#') and len(href) > 1:
+                    links[href[1:]] += 1
+                    count += 1
+        return count
+
+    def merge(self, other: 'LinkChecker') -> None:
+        self.ids.update(other.ids)
+        for chapter, links in other.links.items():
+            merged = self.links.setdefault(chapter, defaultdict(int))
+            for target, count in links.items():
+                merged[target] += count
+
+    def get_dangling(self, expected_ids=()) -> dict:
+        """
+        {chapter: {target id: number of links}} of the links to ids
+        that were neither emitted nor are in expected_ids.
+        """
+        known = self.ids.union(expected_ids)
+        dangling = dict()
+        for chapter, links in self.links.items():
+            missing = {target: count for target, count in links.items() if target not in known}
+            if missing:
+                dangling[chapter] = missing
+        return dangling
+
+
 class Parser:
-    def __init__(self, from_json=True):
+    def __init__(self, from_json=True, cache=None, workers=1, parser_backend='html.parser', extract_backend=None,
+                 incremental=False, assets_dir=None, inline_images_below=0, stats=None, report_path=None,
+                 main_page_url=DOCS_MAIN_PAGE, data_dir=None, parsed_pages=None, memoize=True, fragments=None,
+                 search_dir=None, check_links=None, discover=False, checkpoint_every=20):
         self.from_json = from_json
-        self.main_page_url = \
-            'https://edx.readthedocs.io/projects/open-edx-building-and-running-a-course/en/open-release-nutmeg.master'
+        # timings and counters of this build, written as json to report_path by get_full_html
+        self.stats = stats or BuildStats()
+        self.report_path = report_path
+        # load the json files, then refetch and recompute only the pages that changed upstream
+        self.incremental = incremental
+        # parser_backend builds the trees that get transformed into content.html,
+        # extract_backend (parser_backend by default) the ones we only read ids and toc from
+        self.parser_backend = _check_backend(parser_backend, TRANSFORM_BACKENDS)
+        self.extract_backend = _check_backend(extract_backend or parser_backend, EXTRACT_BACKENDS)
+        self.cache = cache or PageCache()
+        self.cache.stats = self.stats
+        # number of pages downloaded concurrently by prefetch()
+        self.workers = workers
+        # when set, images are downloaded into this directory (relative to content.html)
+        # and referenced from there, images up to inline_images_below bytes become data URIs
+        self.assets_dir = assets_dir
+        self.inline_images_below = inline_images_below
+        self.main_page_url = main_page_url
         self.toc_url = self.main_page_url + '/index.html'
-        self.urls_json = Path(__file__).parent / 'data' / 'urls.json'
-        self.ids_json = Path(__file__).parent / 'data' / 'ids.json'
-        self.toc_json = Path(__file__).parent / 'data' / 'toc.json'
+        # every docs site (see build_targets) keeps its urls, ids and toc in its own directory
+        self.data_dir = Path(data_dir) if data_dir else Path(__file__).parent / 'data'
+        self.urls_json = self.data_dir / 'urls.json'
+        self.ids_json = self.data_dir / 'ids.json'
+        self.toc_json = self.data_dir / 'toc.json'
+        self.fingerprints_json = self.data_dir / 'fingerprints.json'
+        # with discover, an incremental build learns which pages changed from these two files
+        # instead of revalidating every page
+        self.discover = discover
+        self.inventory_url = self.main_page_url + '/objects.inv'
+        self.sitemap_url = self.main_page_url + '/sitemap.xml'
+        self.store_path = self.data_dir / 'store.sqlite'
+        # a crawl (from_json=False) saves its progress here every checkpoint_every pages,
+        # a crawl that did not finish is resumed from it
+        self.checkpoint_path = self.data_dir / 'crawl_checkpoint.json'
+        self.checkpoint_every = checkpoint_every
+        # {'get_ids' / 'get_toc': urls done} while the crawl is checkpointed
+        self._crawled = None
+        # transformed sections are reused while the page, its id map and TRANSFORM_VERSION stay the same
+        self.memoize = memoize
+        self.fragments = fragments or FragmentCache(self.cache.cache_dir / 'fragments')
+        # when set, the rendered chapters are also indexed for search into this directory (relative to content.html)
+        self.search_index = SearchIndex(Path(__file__).parent / search_dir) if search_dir else None
+        # check the '#id' links of the rendered chapters, by default when the whole book is rendered
+        self.check_links = check_links
+        self.link_checker = None
+        # {chapter: {target id: number of links}} of the links to ids missing from the book
+        self.dangling_links = dict()
+        # {new_id: chapter} while save_chapters links the chapters' files to each other
+        self.id_chapters = None
+        # the directory save_chapters writes to, localized images are referenced relative to it
+        self.output_dir = None
 
         self.urls = dict()
         self.ids = dict()
         self.toc = dict()
+        # {url: {'etag': ..., 'last_modified': ..., 'sha256': ...}} of the pages the data was built from
+        self.fingerprints = dict()
+        self.changed_urls = list()
         self.html = ''
-
-        if from_json:
-            self.get_urls_from_json()
-            self.get_ids_from_json()
-            self.get_toc_from_json()
+        # {url: PageArtifacts}, every page is parsed only once
+        self.pages = dict()
+        # {sha256 of the page: PageArtifacts}, can be shared by parsers of sites with identical pages
+        self.parsed_pages = dict() if parsed_pages is None else parsed_pages
+        self._menu_links = None
+        self._title = None
+        self._toc_index = None
+        # chapters of the store whose ids and toc entries are not read yet
+        self._unloaded_chapters = set()
+
+        if from_json or incremental:
+            with self.stats.stage('load data'):
+                if not self.get_from_store():
+                    self.get_urls_from_json()
+                    self.get_ids_from_json()
+                    self.get_toc_from_json()
+                    # built on demand, the json files are what is edited and committed
+                    self.save_as_store()
+            if incremental:
+                self.update_changed_pages()
         else:
-            self.get_urls()
-            self.get_ids(self.urls)
-            self.get_toc()
-            self.save_as_json('urls')
-            self.save_as_json('ids')
-            self.save_as_json('toc')
-
-        self.json_objects_dict = {
-            'urls': (self.urls, self.urls_json),
-            'ids': (self.ids, self.ids_json),
-            'toc': (_json_dumps_tuple_keys(self.toc), self.toc_json)
-        }
+            # the checkpoints and the data are written there
+            self.data_dir.mkdir(parents=True, exist_ok=True)
+            self.resume_crawl()
+            with self.stats.stage('get_urls'):
+                self.get_urls()
+            with self.stats.stage('get_ids'):
+                self.get_ids(self.urls)
+            with self.stats.stage('get_toc'):
+                self.get_toc()
+            lastmods = dict()
+            if discover:
+                # cached and fingerprinted for the next incremental build
+                self.get_inventory()
+                lastmods = self.get_lastmods()
+            self.fingerprints = self.get_fingerprints(lastmods)
+            self.save_data()
+            self.checkpoint_path.unlink(missing_ok=True)
+            self._crawled = None
+
+    def __getstate__(self) -> dict:
+        # what a chapter rendering worker needs, without the pages parsed so far
+        state = self.__dict__.copy()
+        state['pages'] = dict()
+        state['parsed_pages'] = dict()
+        if self.search_index is not None:
+            state['search_index'] = SearchIndex(self.search_index.directory)
+        state['_menu_links'] = None
+        state['html'] = ''
+        return state
 
     def save_as_json(self, object_name: str) -> None:
+        self.load_all_chapters()
         object_to_save, json_path = {
             'urls': (self.urls, self.urls_json),
-            'ids': (self.ids, self.ids_json),
-            'toc': (_json_dumps_tuple_keys(self.toc), self.toc_json)
+            'ids': ({chapter: {url: dict(ids) for url, ids in urls.items()} for chapter, urls in self.ids.items()},
+                    self.ids_json),
+            'toc': (_json_dumps_tuple_keys(self.toc), self.toc_json),
+            'fingerprints': (self.fingerprints, self.fingerprints_json)
         }.get(object_name)
 
         with open(json_path, "w") as outfile:
             json.dump(object_to_save, outfile)
 
+    def save_data(self) -> None:
+        self.save_as_json('urls')
+        self.save_as_json('ids')
+        self.save_as_json('toc')
+        self.save_as_json('fingerprints')
+        self.save_as_store()
+
+    def save_as_store(self) -> None:
+        """
+        Write urls, ids and toc to a versioned SQLite file: urls are split into
+        an interned prefix and a suffix, toc keys are stored as blobs of their
+        section numbers (_pack_toc_key), which sort like the tuples,
+        and new_ids or links that follow from the filename and old_id are left NULL.
+        """
+        self.load_all_chapters()
+        prefixes = dict()
+
+        def split_url(url: str) -> (int, str):
+            prefix, suffix = url.rsplit('/', 1)
+            if prefix not in prefixes:
+                prefixes[prefix] = len(prefixes)
+            return prefixes[prefix], suffix
+
+        tmp_path = self.store_path.with_suffix('.tmp')
+        tmp_path.unlink(missing_ok=True)
+        con = sqlite3.connect(tmp_path)
+        con.executescript('''
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE prefixes (id INTEGER PRIMARY KEY, prefix TEXT);
+            CREATE TABLE urls (id INTEGER PRIMARY KEY, chapter INTEGER, listed INTEGER, prefix_id INTEGER, suffix TEXT);
+            CREATE TABLE ids (url_id INTEGER, old_id TEXT, new_id TEXT);
+            CREATE INDEX ids_url_id ON ids (url_id);
+            CREATE TABLE toc (key BLOB PRIMARY KEY, title TEXT, filename TEXT, old_id TEXT, new_id TEXT,
+                              link_kind TEXT, link_prefix_id INTEGER, link_suffix TEXT);
+        ''')
+        con.execute('INSERT INTO meta VALUES (?, ?)', ('version', str(STORE_VERSION)))
+        con.execute('INSERT INTO meta VALUES (?, ?)', ('json_sha256', self.get_json_digest()))
+        con.execute('INSERT INTO meta VALUES (?, ?)', ('json_stat', self.get_json_stat()))
+        url_rows, id_rows = list(), list()
+        # {(chapter, url): row id}, listed is 0 for urls that only appear in self.ids
+        url_ids = dict()
+        for chapter, urls in self.urls.items():
+            for url in urls:
+                url_ids[chapter, url] = len(url_rows)
+                url_rows.append((len(url_rows), chapter, 1, *split_url(url)))
+        for chapter, urls in self.ids.items():
+            for url, ids in urls.items():
+                if (chapter, url) not in url_ids:
+                    url_ids[chapter, url] = len(url_rows)
+                    url_rows.append((len(url_rows), chapter, 0, *split_url(url)))
+                base = ids.get('')
+                for old_id, new_id in ids.items():
+                    if old_id != '' and base is not None and new_id == f'{base}{f"-{old_id}" if old_id else ""}':
+                        new_id = None
+                    id_rows.append((url_ids[chapter, url], old_id, new_id))
+        toc_rows = list()
+        for key_idx, v in self.toc.items():
+            link_kind = 'url' if 'url' in v else 'href'
+            new_id = None if v['new_id'] == _toc_new_id(v['filename'], v['old_id']) else v['new_id']
+            link = None, None
+            if v[link_kind] != _toc_link(link_kind, v['filename'], v['old_id'], self.main_page_url):
+                link = split_url(v[link_kind])
+            toc_rows.append((_pack_toc_key(key_idx), v['title'], v['filename'], v['old_id'], new_id, link_kind, *link))
+        con.executemany('INSERT INTO urls VALUES (?, ?, ?, ?, ?)', url_rows)
+        con.executemany('INSERT INTO ids VALUES (?, ?, ?)', id_rows)
+        con.executemany('INSERT INTO toc VALUES (?, ?, ?, ?, ?, ?, ?, ?)', toc_rows)
+        con.executemany('INSERT INTO prefixes VALUES (?, ?)', [(i, p) for p, i in prefixes.items()])
+        con.commit()
+        con.close()
+        os.replace(tmp_path, self.store_path)
+
+    def get_json_digest(self) -> str or None:
+        """
+        Hash of the urls, ids and toc json files, None if any is missing.
+        The store keeps the one it was built from, so that it is not used after the json files change.
+        """
+        digest = hashlib.sha256()
+        for json_path in (self.urls_json, self.ids_json, self.toc_json):
+            try:
+                digest.update(json_path.read_bytes())
+            except FileNotFoundError:
+                return None
+        return digest.hexdigest()
+
+    def get_json_stat(self) -> str or None:
+        """
+        Sizes and modification times of the urls, ids and toc json files, None if any is missing.
+        While they are the ones the store saw, the files are not hashed again.
+        """
+        stats = list()
+        for json_path in (self.urls_json, self.ids_json, self.toc_json):
+            try:
+                stat = json_path.stat()
+            except FileNotFoundError:
+                return None
+            stats.append(f'{stat.st_size}:{stat.st_mtime_ns}')
+        return ' '.join(stats)
+
+    def get_from_store(self) -> bool:
+        """
+        Load urls from the SQLite store, the ids and toc entries of a chapter
+        are read by load_chapter when the chapter is first needed.
+        False if there is no store of the current version,
+        or it was built from other json files than the ones in data_dir.
+        """
+        if not self.store_path.exists():
+            return False
+        con = sqlite3.connect(self.store_path)
+        try:
+            meta = dict(con.execute('SELECT key, value FROM meta'))
+            if int(meta.get('version', 0)) != STORE_VERSION:
+                _logger.warning('%s has version %s, expected %s', self.store_path, meta.get('version'), STORE_VERSION)
+                return False
+            json_stat = self.get_json_stat()
+            if json_stat is not None and meta.get('json_stat') != json_stat:
+                # written or checked out since, only the content tells whether they changed
+                if meta.get('json_sha256') != self.get_json_digest():
+                    _logger.warning('%s is older than the json files, it is rebuilt from them', self.store_path)
+                    return False
+                con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('json_stat', json_stat))
+                con.commit()
+            self._store_prefixes = dict(con.execute('SELECT id, prefix FROM prefixes'))
+            self._store_urls = dict()
+            # row ids of the loaded toc entries and the first id row of the loaded chapters,
+            # whatever order the chapters are loaded in, the data keeps the order of the store
+            self._toc_rows, self._chapter_rows = dict(), dict()
+            self.urls, self.ids, self.toc = dict(), dict(), dict()
+            for url_id, chapter, listed, prefix_id, suffix in con.execute('SELECT * FROM urls ORDER BY id'):
+                self._store_urls[url_id] = f'{self._store_prefixes[prefix_id]}/{suffix}'
+                self._unloaded_chapters.add(chapter)
+                if listed:
+                    self.urls.setdefault(chapter, list()).append(self._store_urls[url_id])
+        finally:
+            con.close()
+        return True
+
+    def load_chapter(self, chapter: int) -> None:
+        """
+        Read the ids and toc entries of chapter from the store, if not read yet.
+        Toc keys are blobs of the section numbers, so a chapter is a key range.
+        """
+        if chapter in self._unloaded_chapters:
+            self._load_from_store({chapter})
+
+    def load_all_chapters(self) -> None:
+        if self._unloaded_chapters:
+            self._load_from_store(set(self._unloaded_chapters))
+
+    def _load_from_store(self, chapters: set) -> None:
+        # one chapter is read by its key range, several in a single pass over the tables
+        ids_query = ('SELECT ids.rowid, urls.chapter, ids.url_id, ids.old_id, ids.new_id '
+                     'FROM ids JOIN urls ON urls.id = ids.url_id ')
+        con = sqlite3.connect(self.store_path)
+        try:
+            if len(chapters) == 1:
+                chapter = next(iter(chapters))
+                id_rows = con.execute(ids_query + 'WHERE urls.chapter = ? ORDER BY ids.rowid', (chapter,)).fetchall()
+                toc_rows = con.execute('SELECT rowid, * FROM toc WHERE key >= ? AND key < ? ORDER BY rowid',
+                                       (_pack_toc_key((chapter,)), _pack_toc_key((chapter + 1,)))).fetchall()
+            else:
+                id_rows = con.execute(ids_query + 'ORDER BY ids.rowid').fetchall()
+                toc_rows = con.execute('SELECT rowid, * FROM toc ORDER BY rowid').fetchall()
+        finally:
+            con.close()
+        for chapter in chapters:
+            self.ids[chapter] = dict()
+        for row_id, chapter, url_id, old_id, new_id in id_rows:
+            if chapter not in chapters:
+                continue
+            self._chapter_rows.setdefault(chapter, row_id)
+            url = self._store_urls[url_id]
+            ids = self.ids[chapter].get(url)
+            if ids is None:
+                ids = self.ids[chapter][url] = IdMap()
+            if new_id is None:
+                ids.add_derived(old_id)
+            else:
+                ids[old_id] = new_id
+        for row_id, key, title, filename, old_id, new_id, link_kind, prefix_id, suffix in toc_rows:
+            key_idx = _unpack_toc_key(key)
+            if key_idx[0] not in chapters:
+                continue
+            self._toc_rows[key_idx] = row_id
+            self.toc[key_idx] = {
+                'title': title,
+                'filename': filename,
+                'old_id': old_id,
+                'new_id': _toc_new_id(filename, old_id) if new_id is None else new_id,
+                link_kind: _toc_link(link_kind, filename, old_id, self.main_page_url) if prefix_id is None
+                else f'{self._store_prefixes[prefix_id]}/{suffix}'
+            }
+        # in the order of the store, which is the order the data was collected in
+        self.ids = dict(sorted(self.ids.items(), key=lambda item: self._chapter_rows.get(item[0], math.inf)))
+        self.toc = dict(sorted(self.toc.items(), key=lambda item: self._toc_rows.get(item[0], math.inf)))
+        self._unloaded_chapters -= chapters
+
+    def resume_crawl(self) -> None:
+        """
+        Start checkpointing the crawl, from the urls, ids, toc and pages done
+        saved by an unfinished crawl of the same site, if there is one.
+        """
+        self._crawled = {'get_ids': set(), 'get_toc': set()}
+        try:
+            with open(self.checkpoint_path) as infile:
+                checkpoint = json.load(infile)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            _logger.warning('ignoring %s, it is not valid json', self.checkpoint_path)
+            return
+        if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint.get('main_page_url') != self.main_page_url:
+            _logger.warning('ignoring %s, it is of version %s for %s', self.checkpoint_path,
+                            checkpoint.get('version'), checkpoint.get('main_page_url'))
+            return
+        self.urls = {int(chapter): urls for chapter, urls in checkpoint['urls'].items()}
+        # pairs rather than dicts, json would turn the None old_id into 'null'
+        self.ids = {int(chapter): {url: IdMap(pairs) for url, pairs in urls.items()}
+                    for chapter, urls in checkpoint['ids'].items()}
+        self.toc = _json_loads_tuple_keys(checkpoint['toc'])
+        self._crawled = {stage: set(urls) for stage, urls in checkpoint['crawled'].items()}
+        _logger.info('resuming the crawl from %s, %s pages done', self.checkpoint_path,
+                     {stage: len(urls) for stage, urls in self._crawled.items()})
+
+    def save_checkpoint(self) -> None:
+        if self._crawled is None:
+            return
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'main_page_url': self.main_page_url,
+            'urls': self.urls,
+            'ids': {chapter: {url: list(ids.items()) for url, ids in urls.items()}
+                    for chapter, urls in self.ids.items()},
+            'toc': _json_dumps_tuple_keys(self.toc),
+            'crawled': {stage: sorted(urls) for stage, urls in self._crawled.items()}
+        }
+        with self.stats.stage('checkpoint'):
+            PageCache._write_atomic(self.checkpoint_path, json.dumps(checkpoint).encode())
+
+    def mark_crawled(self, stage: str, url: str) -> None:
+        # url is done in stage, the state is checkpointed every checkpoint_every pages
+        if self._crawled is None:
+            return
+        self._crawled[stage].add(url)
+        if len(self._crawled[stage]) % self.checkpoint_every == 0:
+            self.save_checkpoint()
+
+    def convert_json_to_store(self) -> None:
+        self.get_urls_from_json()
+        self.get_ids_from_json()
+        self.get_toc_from_json()
+        self.save_as_store()
+
     def get_toc_from_json(self):
         with open(self.toc_json) as infile:
             string = json.load(infile)
         self.toc = _json_loads_tuple_keys(string)
 
     def get_ids_from_json(self):
+        # the url keys share their strings with self.urls
+        known_urls = {url: url for urls in self.urls.values() for url in urls}
         with open(self.ids_json) as infile:
-            self.ids = json.load(infile)
+            self.ids = {int(chapter): {known_urls.get(url, url): IdMap(_json_loads_none_key(ids))
+                                       for url, ids in urls.items()}
+                        for chapter, urls in json.load(infile).items()}
 
     def get_urls_from_json(self):
         with open(self.urls_json) as infile:
-            self.urls = json.load(infile)
+            self.urls = {int(chapter): urls for chapter, urls in json.load(infile).items()}
+
+    def get_fingerprints_from_json(self):
+        if self.fingerprints_json.exists():
+            with open(self.fingerprints_json) as infile:
+                self.fingerprints = json.load(infile)
+
+    def get_fingerprints(self, lastmods=None) -> dict:
+        # lastmods: {url: lastmod from sitemap.xml}, kept for the next discovery
+        fingerprints = dict()
+        for url in [self.toc_url, self.inventory_url] + [url for urls in self.urls.values() for url in urls]:
+            entry = self.cache.get_entry(url)
+            if entry:
+                fingerprints[url] = {k: entry[k] for k in ('etag', 'last_modified', 'sha256')}
+                if lastmods and lastmods.get(url):
+                    fingerprints[url]['lastmod'] = lastmods[url]
+        return fingerprints
+
+    def get_inventory(self, data=None) -> dict or None:
+        """
+        {page url: sorted (name, domain:role, anchor, display name)} of the objects
+        (documents, labels, ...) the site's objects.inv lists, data being
+        an objects.inv body (downloaded by default). None if the site has none.
+        """
+        if data is None:
+            try:
+                data = self.cache.get(self.inventory_url)
+            except urllib.error.HTTPError as exc:
+                _logger.info('no inventory at %s: %s', self.inventory_url, exc)
+                return None
+        pages = defaultdict(list)
+        for name, role, uri, display_name in parse_inventory(data):
+            filename, _, anchor = uri.partition('#')
+            pages[f'{self.main_page_url}/{filename}'].append((name, role, anchor, display_name))
+        return {url: sorted(objects) for url, objects in pages.items()}
+
+    def get_lastmods(self) -> dict:
+        """
+        {page url: lastmod} of the site's sitemap.xml, empty if it has none.
+        The locs are mapped to main_page_url from the common directory of all of them,
+        as the sitemap may be written for another host or version path.
+        """
+        try:
+            lastmods = parse_sitemap(self.cache.get(self.sitemap_url))
+        except urllib.error.HTTPError as exc:
+            _logger.info('no sitemap at %s: %s', self.sitemap_url, exc)
+            return dict()
+        if not lastmods:
+            return lastmods
+        base = os.path.commonprefix(list(lastmods)).rsplit('/', 1)[0]
+        return {f'{self.main_page_url}{loc[len(base):]}': lastmod for loc, lastmod in lastmods.items()}
+
+    def discover_changed_urls(self, urls: list) -> (list, dict):
+        """
+        The urls that may have changed since the data was built, judged from
+        objects.inv and sitemap.xml (two small downloads) instead of every page:
+        pages whose lastmod moved or is unknown, pages whose inventory objects
+        (titles, labels) changed, and the main page whenever documents were added or removed.
+        All urls if the site has no inventory or there is none from the last build.
+        Returns them with {url: lastmod}.
+        """
+        fingerprint = self.fingerprints.get(self.inventory_url)
+        old_inventory = None
+        if fingerprint and self.cache.get_object(fingerprint['sha256']) is not None:
+            old_inventory = self.get_inventory(self.cache.get_object(fingerprint['sha256']))
+        inventory = self.get_inventory()
+        lastmods = self.get_lastmods()
+        if inventory is None or old_inventory is None:
+            return urls, lastmods
+        changed = list()
+        for url in urls:
+            if url == self.toc_url and inventory.keys() != old_inventory.keys():
+                changed.append(url)
+            elif inventory.get(url) != old_inventory.get(url):
+                changed.append(url)
+            elif lastmods.get(url) is None or lastmods[url] != self.fingerprints.get(url, {}).get('lastmod'):
+                changed.append(url)
+        _logger.info('%s of %s pages to revalidate', len(changed), len(urls))
+        self.stats.count('revalidations_skipped', len(urls) - len(changed))
+        return changed, lastmods
+
+    def update_changed_pages(self) -> None:
+        """
+        Revalidate every page against its stored fingerprint and recompute
+        the ids and toc entries of the pages whose content changed.
+        A changed main page may move pages between chapters, so it means a full crawl.
+        With discover, only the pages discover_changed_urls picks are revalidated.
+        """
+        self.get_fingerprints_from_json()
+        self.cache.revalidate = True
+        all_urls = urls = [self.toc_url] + [url for urls in self.urls.values() for url in urls]
+        lastmods = dict()
+        if self.discover:
+            urls, lastmods = self.discover_changed_urls(all_urls)
+            self.cache.mark_fresh(set(all_urls) - set(urls))
+        self.prefetch(urls, max(self.workers, REVALIDATE_WORKERS))
+        fingerprints = self.get_fingerprints(lastmods)
+        # a page evicted from the cache meanwhile has no fingerprint and counts as changed
+        self.changed_urls = [url for url in urls if url not in fingerprints
+                             or self.fingerprints.get(url, {}).get('sha256') != fingerprints[url]['sha256']]
+        _logger.info('%s of %s pages changed', len(self.changed_urls), len(all_urls))
+        if not self.changed_urls:
+            if self.discover and fingerprints != self.fingerprints:
+                # new lastmods or inventory, for the next discovery
+                self.fingerprints = fingerprints
+                self.save_as_json('fingerprints')
+            return
+
+        self.load_all_chapters()
+        if self.toc_url in self.changed_urls:
+            self.urls, self.ids, self.toc = dict(), dict(), dict()
+            self.get_urls()
+            self.get_ids(self.urls)
+            self.get_toc()
+            self.changed_urls = [url for urls in self.urls.values() for url in urls]
+        else:
+            for url in self.changed_urls:
+                self._update_page(url)
+
+        self.fingerprints = self.get_fingerprints(lastmods)
+        self.save_data()
+
+    def _update_page(self, url: str) -> None:
+        chapter = [chapter for chapter, urls in self.urls.items() if url in urls][0]
+        filename = url[len(self.main_page_url) + 1:]
+        # entries found on the page itself are recomputed, the ones from the main page TOC stay
+        self.toc = {k: v for k, v in self.toc.items() if 'url' in v or v['filename'] != filename}
+        self.ids[chapter][url] = IdMap()
+        self.ids[chapter][url][''] = filename.split(".")[0].replace("/", "-")
+        for old_id in self.get_page_artifacts(url).ids:
+            new_id = f'{self.ids[chapter][url][""]}{f"-{old_id}" if old_id else ""}'
+            self.ids[chapter][url][old_id] = new_id
+        for key_idx, v in self.toc.items():
+            if v.get('url', '').split('#')[0] == url:
+                self._update_ids(key_idx, v['url'], v['old_id'], v['new_id'])
+        self.update_toc_dict(url)
+
+    def fragment_key(self, url: str, id_map: dict) -> str:
+        """
+        Hash of what the transformed section of url depends on: the page content,
+        the id map, the path of url below the main page (relative links),
+        the parser backend and TRANSFORM_VERSION. The main page url itself is left out,
+        so the same page of several sites (e.g. releases) is transformed once.
+        """
+        entry = self.cache.get_entry(url)
+        if entry is None:
+            self.get_page(url)
+            entry = self.cache.get_entry(url)
+        key = json.dumps([TRANSFORM_VERSION, self.parser_backend, url[len(self.main_page_url) + 1:], entry['sha256'],
+                          list(id_map.items())])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_fragment(self, key: str) -> BeautifulSoup or None:
+        """
+        The transformed section saved under key by an earlier build, if any.
+        """
+        html = self.fragments.get(key)
+        if html is None:
+            return None
+        self.stats.count('fragments_reused')
+        self.stats.count('sections_parsed')
+        with self.stats.stage('parse'):
+            html = html.replace(FRAGMENT_MAIN_PAGE, self.main_page_url)
+            return BeautifulSoup(html, self.parser_backend).find('section')
+
+    def save_fragment(self, key: str, section: BeautifulSoup) -> None:
+        self.fragments.put(key, str(section))
+
+    def put_main_page_back(self, section: BeautifulSoup) -> None:
+        # the image urls rewrite_section made absolute for FRAGMENT_MAIN_PAGE
+        def from_fragment(t: BeautifulSoup) -> bool:
+            return any(t.get(a, '').startswith(FRAGMENT_MAIN_PAGE) for a in ('src', 'href'))
+
+        for tag in section.find_all(from_fragment):
+            for attr in ('src', 'href'):
+                if tag.get(attr, '').startswith(FRAGMENT_MAIN_PAGE):
+                    tag[attr] = self.main_page_url + tag[attr][len(FRAGMENT_MAIN_PAGE):]
+
+    def get_page(self, url: str) -> str:
+        # every page download goes through the on-disk cache
+        with self.stats.stage('get_page'):
+            return self.cache.get(url).decode()
+
+    def prefetch(self, urls: list, workers=None) -> None:
+        """
+        Download urls into the page cache with a pool of workers (self.workers by default) threads,
+        so that the serial passes over them only read from disk.
+        """
+        workers = workers or self.workers
+        if workers < 2:
+            return
+        _logger.info('prefetching %s urls with %s workers', len(urls), workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # consume the results to re-raise download errors here
+            for _ in executor.map(self.cache.get, urls):
+                pass
+
+    def get_page_artifacts(self, url: str, backend=None) -> PageArtifacts:
+        """
+        Parse the page behind url once and keep only what the later passes need:
+        the ids (get_ids), the numbered sections (update_toc_dict)
+        and the serialized content section (get_chapter_html).
+        backend (extract_backend by default) is used if the page is not parsed yet,
+        the section is kept only from a parser_backend tree.
+        """
+        backend = backend or self.extract_backend
+        page = self.pages.get(url)
+        if page is None:
+            output = self.get_page(url)
+            digest = hashlib.sha256(output.encode()).hexdigest()
+            page = self.parsed_pages.get(digest)
+        if page is None:
+            self.stats.count('pages_parsed')
+            with self.stats.stage('parse'):
+                if backend == 'selectolax':
+                    page = PageArtifacts.from_lexbor(LexborHTMLParser(output))
+                else:
+                    soup = BeautifulSoup(output, backend)
+                    page = PageArtifacts.from_soup(soup)
+                    if backend != self.parser_backend:
+                        page.section_html = None
+                    soup.decompose()
+            self.parsed_pages[digest] = page
+        self.pages[url] = page
+        return page
+
+    def get_page_section(self, url: str) -> BeautifulSoup:
+        # a page not parsed yet (e.g. with the ids and toc read from data/) is parsed once, with parser_backend
+        page = self.get_page_artifacts(url, self.parser_backend)
+        if page.section_html is None:
+            # extracted with another backend by the crawl, take the section from a parser_backend tree
+            output = self.get_page(url)
+            self.stats.count('pages_parsed')
+            with self.stats.stage('parse'):
+                soup = BeautifulSoup(output, self.parser_backend)
+                page.section_html = str([s for s in soup.find_all('section') if s.attrs.get('id')][0])
+                soup.decompose()
+        self.stats.count('sections_parsed')
+        with self.stats.stage('parse'):
+            return BeautifulSoup(page.section_html, self.parser_backend).find('section')
+
+    def get_menu_links(self) -> list:
+        """
+        (text, href) of every link in the sidebar menu of the main page,
+        in the order get_urls and get_toc visit them.
+        """
+        if self._menu_links is None:
+            output = self.get_page(self.toc_url)
+            if self.extract_backend == 'selectolax':
+                self._menu_links = _get_menu_links_from_lexbor(LexborHTMLParser(output))
+            else:
+                self._menu_links = _get_menu_links_from_soup(BeautifulSoup(output, self.extract_backend))
+        return self._menu_links
 
     def get_urls(self) -> None:
         _logger.info('collecting urls')
-        url = _iri_to_uri(self.toc_url)
         # get urls from main page TOC
-        with urllib.request.urlopen(url) as response:
-            output = response.read().decode()
-            soup = BeautifulSoup(output, 'html.parser')
-        content = soup.find_all('div', {"class": 'wy-menu wy-menu-vertical'})[0]
-        toc = content.find('ul')
-        lis = toc.find_all('li')
-        for li in lis:
-            a_tag = li.find_all('a')
-            for i in a_tag:
-                contents = [x for x in i.contents if not x.name][0]
-                idxs, title = contents.split('. ')
-                key_idx = (tuple(map(int, idxs.split('.'))))
-                chapter = key_idx[0]
-                href = i.get('href').split('#')[0]
-                href = f"{DOCS_MAIN_PAGE}/{href}"
-                self.urls[chapter] = self.urls.get(chapter) or list()
-                if href not in self.urls[chapter]:
-                    self.urls[chapter].append(href)
+        for contents, href in self.get_menu_links():
+            idxs, title = contents.split('. ')
+            key_idx = (tuple(map(int, idxs.split('.'))))
+            chapter = key_idx[0]
+            href = href.split('#')[0]
+            href = f"{self.main_page_url}/{href}"
+            self.urls[chapter] = self.urls.get(chapter) or list()
+            if href not in self.urls[chapter]:
+                self.urls[chapter].append(href)
+        if not self.urls:
+            raise ValueError(f'no numbered links in the sidebar menu of {self.toc_url}, has the theme changed?')
         _logger.info('url collected')
 
     def get_ids(self, urls_dict: dict) -> None:
         _logger.info('collecting ids...')
-        # {chapter_number: {url: {old_id: new_id}}}
+        # {chapter_number: {url: IdMap {old_id: new_id}}}
+        crawled = self._crawled['get_ids'] if self._crawled else set()
+        self.prefetch([url for urls in urls_dict.values() for url in urls if url not in crawled])
         for chapter, urls in urls_dict.items():
             _logger.info('... from chapter %s', chapter)
-            self.ids[chapter] = dict()
+            if not crawled or chapter not in self.ids:
+                self.ids[chapter] = dict()
             for url in urls:
-                filename = url[len(DOCS_MAIN_PAGE) + 1:].split(".")[0].replace("/", "-")
-                self.ids[chapter][url] = dict()
+                if url in crawled:
+                    continue
+                filename = url[len(self.main_page_url) + 1:].split(".")[0].replace("/", "-")
+                self.ids[chapter][url] = IdMap()
                 self.ids[chapter][url][''] = filename
-                with urllib.request.urlopen(url) as response:
-                    output = response.read().decode()
-                    soup = BeautifulSoup(output, 'html.parser')
-                    tags_with_id = soup.find_all(lambda t: t.has_attr('id'))
-                    for tag in tags_with_id:
-                        old_id = tag.attrs.get('id')
-                        new_id = f'{filename}{f"-{old_id}" if old_id else ""}'
-                        self.ids[chapter][url][old_id] = new_id
+                for old_id in self.get_page_artifacts(url).ids:
+                    new_id = f'{filename}{f"-{old_id}" if old_id else ""}'
+                    self.ids[chapter][url][old_id] = new_id
+                self.mark_crawled('get_ids', url)
+        self.save_checkpoint()
         _logger.info('ids collected')
 
     def _update_ids(self, key_idx: tuple, url: str, old_id: str, new_id: str) -> None:
@@ -177,107 +1762,73 @@ class Parser:
             _logger.error(f"saved_new_id: {saved_new_id}")
 
     def update_toc_dict(self, url: str) -> None:
-        def get_id_and_title_from_ascendant_section(t: BeautifulSoup) -> (int or None, str):
-            p = t.parent
-            while True:
-                if p.name == 'section' and p.attrs.get('id'):
-                    tid = p.attrs.get('id')
-                    break
-                p = p.parent
-            p = t.parent
-            title_l = [x.strip(' \n') for x in p.contents if not x.name]
-            title_l = [x for x in title_l if x]
-            if title_l:
-                ttl = title_l[0]
-            else:
-                try:
-                    ttl = p.find('code').find('span').string
-                except Exception as exc:
-                    print('key_idx: ', key_idx)
-                    print('tag: ', t)
-                    print('parent: ', p.name)
-                    print('filename: ', filename)
-                    print('old_id: ', old_id)
-                    print('new_id: ', new_id)
-                    print('title: ', title)
-                    print('.' * 30)
-                    print(p.parent)
-                    raise exc
-            return tid, ttl
-
-        with urllib.request.urlopen(url) as response:
-            output = response.read().decode()
-            soup = BeautifulSoup(output, 'html.parser')
-            sections = soup.find_all('section')
-            section = [s for s in sections if s.attrs.get('id')][0]
-            # get ids from class='session-number'
-            section_numbers_tags = section.find_all(class_='section-number')
-            filename = url[len(DOCS_MAIN_PAGE) + 1:]
-            for tag in section_numbers_tags:
-                key_idx = tuple(map(int, tag.string.strip('. ').split('.')))
-                if key_idx in self.toc:
-                    continue
-
-                old_id, title = get_id_and_title_from_ascendant_section(tag)
-                new_id = f'{filename.split(".")[0].replace("/", "-")}{"-" + old_id if old_id else ""}'
-                self._update_ids(key_idx, url, old_id, new_id)
-
-                self.toc[key_idx] = {
-                    'title': title,
-                    'filename': filename,
-                    'old_id': old_id,
-                    'new_id': new_id,
-                    'href': f"{url}#{old_id}"
-                }
+        page = self.get_page_artifacts(url)
+        filename = url[len(self.main_page_url) + 1:]
+        for key_idx, old_id, title in page.toc_entries:
+            if key_idx in self.toc:
+                continue
+            if title is None:
+                raise ValueError(f'no title found for section {key_idx} in {filename}')
+
+            new_id = f'{filename.split(".")[0].replace("/", "-")}{"-" + old_id if old_id else ""}'
+            self._update_ids(key_idx, url, old_id, new_id)
+
+            self.toc[key_idx] = {
+                'title': title,
+                'filename': filename,
+                'old_id': old_id,
+                'new_id': new_id,
+                'href': f"{url}#{old_id}"
+            }
 
     def get_toc(self) -> None:
         _logger.info('collecting toc from main page')
-        url = _iri_to_uri(self.toc_url)
         # get content from main page TOC
-        with urllib.request.urlopen(url) as response:
-            output = response.read().decode()
-            soup = BeautifulSoup(output, 'html.parser')
-        content = soup.find_all('div', {"class": 'wy-menu wy-menu-vertical'})[0]
-        toc = content.find('ul')
-        lis = toc.find_all('li')
-        for li in lis:
-            a_tag = li.find_all('a')
-            for i in a_tag:
-                idxs, title = i.contents[0].split('. ')
-                key_idx = (tuple(map(int, idxs.split('.'))))
-                href = i.get('href')
-                filename, old_id, new_id = parse_href(href)
-                url = f"{DOCS_MAIN_PAGE}/{href}"
+        for contents, href in self.get_menu_links():
+            idxs, title = contents.split('. ')
+            key_idx = (tuple(map(int, idxs.split('.'))))
+            filename, old_id, new_id = parse_href(href)
+            url = f"{self.main_page_url}/{href}"
 
-                self._update_ids(key_idx, url, old_id, new_id)
+            self._update_ids(key_idx, url, old_id, new_id)
 
-                self.toc[key_idx] = {
-                    'title': title,
-                    'filename': filename,
-                    'old_id': old_id,
-                    'new_id': new_id,
-                    'url': url
-                }
+            self.toc[key_idx] = {
+                'title': title,
+                'filename': filename,
+                'old_id': old_id,
+                'new_id': new_id,
+                'url': url
+            }
         _logger.info('toc from main page collected')
         _logger.info('collecting toc from other urls')
         # get additional content from all urls
+        crawled = self._crawled['get_toc'] if self._crawled else set()
+        self.prefetch([url for urls in self.urls.values() for url in urls if url not in crawled])
         try:
             for chapter, urls in self.urls.items():
                 _logger.info('chapter %s', chapter)
                 for url in urls:
+                    if url in crawled:
+                        continue
                     _logger.info('url: %s', url)
                     self.update_toc_dict(url)
+                    self.mark_crawled('get_toc', url)
         except TypeError:
-            print(self.urls)
+            _logger.error('urls: %s', self.urls)
             raise
 
+    @property
+    def toc_index(self) -> TocIndex:
+        if self._toc_index is None or not self._toc_index.is_current(self.toc):
+            self._toc_index = TocIndex(self.toc)
+        return self._toc_index
+
     def _get_section_indexes_from_toc(self, chapter: int) -> list:
-        indexes = sorted(list(self.toc.keys()))
         if chapter:
-            indexes = [idx for idx in indexes if idx[0] == chapter]
-        else:
-            indexes = [idx for idx in indexes if len(idx) < 3]
-        return indexes
+            self.load_chapter(chapter)
+            return self.toc_index.chapter(chapter)
+        self.load_all_chapters()
+        return self.toc_index.up_to_depth(2)
 
     def get_toc_html_from_dict(self, chapter: int) -> BeautifulSoup:
         indexes = self._get_section_indexes_from_toc(chapter)
@@ -307,11 +1858,12 @@ class Parser:
         return soup
 
     def get_chapter_dirs_and_id_replacement_pairs(self, chapter: int) -> dict:
-        chapter_ids = sorted([k for k in self.toc.keys() if k[0] == chapter])
+        self.load_chapter(chapter)
+        chapter_ids = self.toc_index.chapter(chapter)
         chapter_dirs = dict()
         for idx in chapter_ids:
             chapter_filename = self.toc[idx]['filename']
-            chapter_dir = f'{DOCS_MAIN_PAGE}/{chapter_filename}'
+            chapter_dir = f'{self.main_page_url}/{chapter_filename}'
             if chapter_dir not in chapter_dirs:
                 chapter_dirs[chapter_dir] = list()
             chapter_dirs[chapter_dir].append((self.toc[idx]['old_id'], self.toc[idx]['new_id']))
@@ -339,7 +1891,7 @@ class Parser:
         return soup
 
     @staticmethod
-    def clean_hrefs(soup: BeautifulSoup, url: str) -> BeautifulSoup:
+    def clean_hrefs(soup: BeautifulSoup, url: str, main_page_url=DOCS_MAIN_PAGE) -> BeautifulSoup:
         def href_with_id(t: BeautifulSoup) -> bool:
             return t.has_attr('href') and t.get('href').startswith('#id')
 
@@ -363,7 +1915,7 @@ class Parser:
 
         # change relative hrefs into absolute
         tags = soup.find_all(href_relative)
-        base_path = url[len(DOCS_MAIN_PAGE) + 1:].split('/')
+        base_path = url[len(main_page_url) + 1:].split('/')
         for tag in tags:
             href = tag.get('href')
             href, folders_up = strip_href_from_folder_up(href)
@@ -374,7 +1926,7 @@ class Parser:
         return soup
 
     @staticmethod
-    def replace_img_sources(soup: BeautifulSoup) -> BeautifulSoup:
+    def replace_img_sources(soup: BeautifulSoup, main_page_url=DOCS_MAIN_PAGE) -> BeautifulSoup:
         def href_for_image(t: BeautifulSoup) -> bool:
             return t.has_attr('href') and '_image' in t.get('href')
 
@@ -384,38 +1936,128 @@ class Parser:
         tags = soup.find_all(href_for_image)
         for tag in tags:
             th = tag["href"]
-            tag['href'] = f'{DOCS_MAIN_PAGE}/{th[th.find("_image"):]}'
+            tag['href'] = f'{main_page_url}/{th[th.find("_image"):]}'
         tags = soup.find_all(src_for_image)
         for tag in tags:
             ts = tag["src"]
-            tag['src'] = f'{DOCS_MAIN_PAGE}/{ts[ts.find("_image"):]}'
+            tag['src'] = f'{main_page_url}/{ts[ts.find("_image"):]}'
 
         return soup
 
+    @staticmethod
+    def remove_redundant_hrefs(soup: BeautifulSoup) -> BeautifulSoup:
+        tags = soup.find_all(lambda t: t.has_attr('href') and t.get('href').startswith('#id'))
+        for tag in tags:
+            tag.unwrap()
+        return soup
+
+    @staticmethod
+    def rewrite_section(soup: BeautifulSoup, id_map: dict, url: str, unwrap=True, stats=None,
+                        main_page_url=DOCS_MAIN_PAGE) -> BeautifulSoup:
+        """
+        Same result as lower_headings, replace_id for every (old_id, new_id) pair of id_map,
+        replace_img_sources and clean_hrefs applied one after another,
+        but in a single walk over the tree with dict lookups instead of a search per id.
+        With unwrap=False the '#id...' links are left for remove_redundant_hrefs.
+        stats, a BuildStats, counts the nodes visited and the ids rewritten.
+        """
+        base_path = url[len(main_page_url) + 1:].split('/')
+        href_map = {f'#{old_id}': f'#{new_id}' for old_id, new_id in id_map.items()}
+        # replace_id renames only the first tag with a given id,
+        # and soup.find(id=None) is the first tag without an id
+        replaced_ids = set()
+        tags = soup.find_all(True)
+        for tag in tags:
+            if tag.name in ('h1', 'h2', 'h3', 'h4', 'h5'):
+                tag.name = f'h{int(tag.name[1]) + 1}'
+
+            tag_id = tag.attrs.get('id')
+            if tag_id is not None and tag_id in id_map and tag_id not in replaced_ids:
+                replaced_ids.add(tag_id)
+                tag.attrs['id'] = id_map[tag_id]
+            elif tag_id is None and None in id_map and None not in replaced_ids:
+                replaced_ids.add(None)
+                tag.attrs['id'] = id_map[None]
+
+            src = tag.attrs.get('src')
+            if src is not None and '_image' in src:
+                tag['src'] = f'{main_page_url}/{src[src.find("_image"):]}'
+
+            href = tag.attrs.get('href')
+            if href is None:
+                continue
+            href = href_map.get(href, href)
+            if '_image' in href:
+                href = f'{main_page_url}/{href[href.find("_image"):]}'
+            if href.startswith('#id'):
+                # remove_redundant_hrefs
+                if unwrap:
+                    tag.unwrap()
+                continue
+            if '.html' in href and not href.startswith('http'):
+                # change relative hrefs into absolute
+                folders_up = 0
+                while href.startswith('../'):
+                    href = href[3:]
+                    folders_up += 1
+                href = '/'.join(base_path[:-(folders_up + 1)]) + '/' + href
+                filename, old_id, new_id = parse_href(href)
+                href = f'#{new_id}'
+            tag.attrs['href'] = href
+        if stats:
+            stats.count('nodes_visited', len(tags))
+            stats.count('ids_rewritten', len(replaced_ids))
+        return soup
+
+    def get_asset(self, url: str) -> str:
+        """
+        Store the image behind url in self.assets_dir under its content hash,
+        so every distinct image is kept once, and return its relative path.
+        Downloads go through the page cache, so re-runs only fetch new or changed images.
+        """
+        body = self.cache.get(url)
+        name = f'{hashlib.sha256(body).hexdigest()[:16]}{Path(urllib.parse.urlsplit(url).path).suffix}'
+        path = Path(__file__).parent / self.assets_dir / name
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            PageCache._write_atomic(path, body)
+        return f'{Path(self.assets_dir).as_posix()}/{name}'
+
+    def localize_images(self, soup: BeautifulSoup) -> BeautifulSoup:
+        """
+        Point the image sources and links made absolute by replace_img_sources
+        to local copies, or to data URIs for small images.
+        """
+        image_prefix = f'{self.main_page_url}/_images/'
+        tags = soup.find_all(lambda t: any(t.get(a, '').startswith(image_prefix) for a in ('src', 'href')))
+        urls = list(dict.fromkeys(t.get(a) for t in tags for a in ('src', 'href')
+                                  if t.get(a, '').startswith(image_prefix)))
+        self.prefetch(urls)
+        local_paths = {url: self.get_asset(url) for url in urls}
+        for tag in tags:
+            for attr in ('src', 'href'):
+                url = tag.get(attr, '')
+                if not url.startswith(image_prefix):
+                    continue
+                local_path = Path(__file__).parent / local_paths[url]
+                if attr == 'src' and local_path.stat().st_size <= self.inline_images_below:
+                    mime_type = mimetypes.guess_type(local_path.name)[0] or 'application/octet-stream'
+                    tag[attr] = f'data:{mime_type};base64,{base64.b64encode(local_path.read_bytes()).decode()}'
+                elif self.output_dir is not None:
+                    # local_paths are relative to content.html
+                    tag[attr] = Path(os.path.relpath(local_path, self.output_dir)).as_posix()
+                else:
+                    tag[attr] = local_paths[url]
+        return soup
+
     def get_chapter_html(self, chapter: int) -> BeautifulSoup:
-        print(chapter)
-        try:
-            chapter_dirs_with_ids_dict = self.ids[chapter]
-        except KeyError:
-            print(self.ids.keys())
-            raise
-            # todo: keys are strings, should be integers
+        _logger.debug('chapter %s', chapter)
         chapter_soup = BeautifulSoup()
-        if not chapter_dirs_with_ids_dict:
-            return chapter_soup
-        for url in chapter_dirs_with_ids_dict:
-            print(url)
-            with urllib.request.urlopen(url) as response:
-                output = response.read().decode()
-                soup = BeautifulSoup(output, 'html.parser')
-                sections = soup.find_all('section')
-                section = [s for s in sections if s.attrs.get('id')][0]
-                section = self.lower_headings(section)
-                for old_id, new_id in chapter_dirs_with_ids_dict[url].items():
-                    section = self.replace_id(section, old_id, new_id)
-                section = self.replace_img_sources(section)
-                section = self.clean_hrefs(section, url)
+        for url, section in self.iter_chapter_sections(chapter):
             chapter_soup.append(section)
+        if self.assets_dir:
+            with self.stats.stage('localize images'):
+                chapter_soup = self.localize_images(chapter_soup)
         # todo: clean (?)
         # todo: add links from sections to tocs
         # todo: clean tags like:
@@ -424,7 +2066,156 @@ class Parser:
         #  </a>
         return chapter_soup
 
-    def get_full_html(self) -> None:
+    def iter_chapter_sections(self, chapter: int):
+        """
+        Yield (url, transformed section) for every page of chapter, in order.
+        """
+        self.load_chapter(chapter)
+        try:
+            chapter_dirs_with_ids_dict = self.ids[chapter]
+        except KeyError:
+            _logger.error('chapter %s not found, the chapters are %s', chapter, sorted(self.ids))
+            raise
+        for url in chapter_dirs_with_ids_dict:
+            _logger.debug('url: %s', url)
+            if self.memoize:
+                # fragments are saved before unwrapping, which would split strings
+                # in a way that does not survive serialization
+                key = self.fragment_key(url, chapter_dirs_with_ids_dict[url])
+                section = self.get_fragment(key)
+                if section is None:
+                    section = self.get_page_section(url)
+                    with self.stats.stage('rewrite'):
+                        section = self.rewrite_section(section, chapter_dirs_with_ids_dict[url],
+                                                       FRAGMENT_MAIN_PAGE + url[len(self.main_page_url):],
+                                                       unwrap=False, stats=self.stats, main_page_url=FRAGMENT_MAIN_PAGE)
+                    self.save_fragment(key, section)
+                    self.put_main_page_back(section)
+                section = self.remove_redundant_hrefs(section)
+            else:
+                section = self.get_page_section(url)
+                with self.stats.stage('rewrite'):
+                    section = self.rewrite_section(section, chapter_dirs_with_ids_dict[url], url, stats=self.stats,
+                                                   main_page_url=self.main_page_url)
+            yield url, section
+
+    def export_epub(self, chapters=None, filename='content.epub') -> None:
+        """
+        Write the chapters (all by default) as an EPUB 3 book, one XHTML spine item
+        per page, written to the zip as soon as its section is transformed.
+        Links are pointed to the item holding their target by the ids and toc data,
+        the nav document is built from the toc keys, and every distinct image
+        is stored once under its content hash.
+        """
+        chapters = list(chapters or self.chapters)
+        for chapter in chapters:
+            self.load_chapter(chapter)
+        # {url: item name} and {new_id: item name}, known before any item is written
+        url_items, id_items = dict(), dict()
+        for chapter in chapters:
+            for url, ids in self.ids.get(chapter, dict()).items():
+                url_items[url] = f'p{len(url_items) + 1}.xhtml'
+                for new_id in ids.values():
+                    id_items.setdefault(new_id, url_items[url])
+        for chapter in chapters:
+            for key_idx in self.toc_index.chapter(chapter):
+                v = self.toc[key_idx]
+                item = url_items.get(f'{self.main_page_url}/{v["filename"]}')
+                if item:
+                    id_items.setdefault(v['new_id'], item)
+
+        image_prefix = f'{self.main_page_url}/_images/'
+        # {image name: media type}
+        images = dict()
+        book_title = self.title
+        css_path = Path(__file__).parent / 'style.css'
+        with zipfile.ZipFile(Path(__file__).parent / filename, 'w', zipfile.ZIP_DEFLATED) as book:
+            book.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+            book.writestr('META-INF/container.xml', EPUB_CONTAINER_XML)
+            if css_path.exists():
+                book.write(css_path, 'OEBPS/style.css')
+            for chapter in chapters:
+                _logger.info('exporting chapter %s', chapter)
+                for url, section in self.iter_chapter_sections(chapter):
+                    item = url_items[url]
+                    image_urls = [t.get('src') for t in section.find_all(src=re.compile(f'^{re.escape(image_prefix)}'))]
+                    self.prefetch(list(dict.fromkeys(image_urls)))
+                    with self.stats.stage('epub'):
+                        for tag in section.find_all(['script', 'style']):
+                            tag.decompose()
+                        for tag in section.find_all(lambda t: t.has_attr('href') or t.has_attr('src')):
+                            for attr in ('href', 'src'):
+                                value = tag.get(attr)
+                                if value is None:
+                                    continue
+                                if value.startswith('#') and id_items.get(value[1:], item) != item:
+                                    tag[attr] = f'{id_items[value[1:]]}{value}'
+                                elif value.startswith(image_prefix):
+                                    body = self.cache.get(value)
+                                    name = f'{hashlib.sha256(body).hexdigest()[:16]}' \
+                                           f'{Path(urllib.parse.urlsplit(value).path).suffix}'
+                                    if name not in images:
+                                        images[name] = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                                        book.writestr(f'OEBPS/images/{name}', body)
+                                    tag[attr] = f'../images/{name}'
+                        heading = section.find(re.compile('^h[1-6]$'))
+                        title = heading.get_text(' ', strip=True).rstrip('\u00b6').strip() if heading else book_title
+                        book.writestr(f'OEBPS/text/{item}', EPUB_PAGE_XHTML.format(
+                            title=escape(title), css='../style.css', body=section))
+                    section.decompose()
+                self.release_pages(self.ids.get(chapter, dict()))
+
+            book.writestr('OEBPS/nav.xhtml', EPUB_PAGE_XHTML.format(
+                title=escape(book_title), css='style.css', body=self.get_epub_nav(chapters, id_items, url_items)))
+            manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+            if css_path.exists():
+                manifest.append('<item id="css" href="style.css" media-type="text/css"/>')
+            for item in url_items.values():
+                manifest.append(f'<item id="{item[:-6]}" href="text/{item}" media-type="application/xhtml+xml"/>')
+            for i, (name, media_type) in enumerate(images.items()):
+                manifest.append(f'<item id="i{i + 1}" href="images/{name}" media-type="{media_type}"/>')
+            spine = [f'<itemref idref="{item[:-6]}"/>' for item in url_items.values()]
+            book.writestr('OEBPS/content.opf', EPUB_PACKAGE_OPF.format(
+                identifier=uuid.uuid5(uuid.NAMESPACE_URL, self.main_page_url), title=escape(book_title),
+                modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                manifest='\n    '.join(manifest), spine='\n    '.join(spine)))
+        self.stats.count('epub_images', len(images))
+
+    def get_epub_nav(self, chapters: list, id_items: dict, url_items: dict) -> str:
+        # nested lists of the toc entries, each under its parent entry
+        children = defaultdict(list)
+        for chapter in chapters:
+            for key_idx in self.toc_index.chapter(chapter):
+                children[self.toc_index.parent(key_idx) or ()].append(key_idx)
+
+        def get_list(parent: tuple) -> str:
+            items = list()
+            for key_idx in children[parent]:
+                v = self.toc[key_idx]
+                item = id_items.get(v['new_id']) or url_items.get(f'{self.main_page_url}/{v["filename"]}')
+                if item is None:
+                    continue
+                title = escape(f'{".".join(map(str, key_idx))} {v["title"]}')
+                sublist = get_list(key_idx) if children[key_idx] else ''
+                href = quoteattr(f'text/{item}#{v["new_id"]}')
+                items.append(f'<li><a href={href}>{title}</a>{sublist}</li>')
+            return f'<ol>{"".join(items)}</ol>' if items else ''
+
+        return f'<nav epub:type="toc" id="toc"><h1>Contents</h1>{get_list(())}</nav>'
+
+    @property
+    def title(self) -> str:
+        """
+        The heading of the main page, DOCS_TITLE if it has none.
+        """
+        if self._title is None:
+            soup = BeautifulSoup(self.get_page(self.toc_url), self.parser_backend)
+            heading = soup.find('h1')
+            self._title = heading.get_text(strip=True).rstrip('\u00b6').strip() if heading else DOCS_TITLE
+            soup.decompose()
+        return self._title
+
+    def get_html_shell(self) -> (BeautifulSoup, BeautifulSoup):
         soup = BeautifulSoup()
         html = soup.new_tag('html')
         soup.append(html)
@@ -439,17 +2230,391 @@ class Parser:
         html.append(body)
         h1 = soup.new_tag('h1')
         body.append(h1)
-        h1.string = 'Building and Running an Open edX Course: Nutmeg Release'
-        chapters_number = max(self.toc.keys(), key=lambda x: x[0])[0]
-        # for chapter in range(chapters_number + 1):
-        for chapter in [6]:
-            print(chapter)
-            chapter_toc = self.get_toc_html_from_dict(chapter)
-            body.append(chapter_toc)
-            chapter_content = self.get_chapter_html(chapter)
-            body.append(chapter_content)
+        h1.string = self.title
+        return soup, body
+
+    @property
+    def chapters(self) -> list:
+        return sorted(set(self.toc_index.chapters()).union(self._unloaded_chapters))
+
+    def render_chapter(self, chapter: int) -> str:
+        """
+        The chapter's toc and content, prettified as they appear in the book,
+        with the chapter's trees and parsed pages freed afterwards.
+        """
+        _logger.info('rendering chapter %s', chapter)
+        with self.stats.stage('render chapter'):
+            with self.stats.stage('toc html'):
+                toc_soup = self.get_toc_html_from_dict(chapter)
+            with self.stats.stage('chapter html'):
+                chapter_soup = self.get_chapter_html(chapter)
+            if self.search_index is not None:
+                with self.stats.stage('index'):
+                    self.stats.count('tokens_indexed', self.search_index.add(chapter_soup))
+            if self.link_checker is not None:
+                with self.stats.stage('collect links'):
+                    self.stats.count('links_checked', self.link_checker.add_chapter(chapter, toc_soup, chapter_soup))
+            if self.id_chapters is not None:
+                self.link_to_chapter_files(chapter, toc_soup, chapter_soup)
+            pieces = list()
+            with self.stats.stage('serialize'):
+                for soup in (toc_soup, chapter_soup):
+                    # body children are indented by two levels in the prettified document
+                    for element in soup.contents:
+                        pieces.append(element.decode(indent_level=2))
+                    soup.decompose()
+        self.release_pages(self.ids.get(chapter, dict()))
+        return ''.join(pieces)
+
+    def release_pages(self, urls) -> None:
+        """
+        Forget the parsed pages of urls (e.g. of a rendered chapter),
+        so that a streamed build keeps only the pages of the chapter at hand.
+        """
+        released = {id(self.pages.pop(url)) for url in urls if url in self.pages}
+        if released:
+            # a list first, the pipeline parses the next pages in other threads meanwhile
+            for digest in [d for d, page in list(self.parsed_pages.items()) if id(page) in released]:
+                self.parsed_pages.pop(digest, None)
+
+    def iter_full_html(self, chapters=(6,), processes=1):
+        """
+        Yield the prettified book piece by piece, the same text get_full_html produces,
+        one chapter at a time, so that peak memory is bounded by the largest chapter.
+        With processes > 1 the chapters are rendered in a process pool
+        and still yielded in order.
+        """
+        self._begin_link_check(chapters)
+        shell_start, shell_end = self.get_html_shell_parts()
+        yield shell_start
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_render_worker,
+                                     initargs=(self,)) as executor:
+                for result in executor.map(_render_chapter_in_worker, chapters):
+                    yield self._merge_worker_result(result)
+        else:
+            for chapter in chapters:
+                yield self.render_chapter(chapter)
+        self._end_link_check(chapters)
+        if self.search_index is not None:
+            self.search_index.save()
+        yield shell_end
+
+    def _merge_worker_result(self, result: tuple) -> str:
+        chapter_html, report, search_index, link_checker = result
+        self.stats.merge(report)
+        if search_index is not None:
+            self.search_index.merge(search_index)
+        if link_checker is not None:
+            self.link_checker.merge(link_checker)
+        return chapter_html
+
+    def _begin_link_check(self, chapters: list) -> None:
+        whole_book = set(chapters) >= set(self.chapters)
+        check = self.check_links if self.check_links is not None else whole_book
+        self.link_checker = LinkChecker() if check else None
+
+    def _end_link_check(self, chapters: list) -> None:
+        """
+        Find the links to ids that are neither in the rendered chapters
+        nor expected (by self.ids and self.toc) in the chapters not rendered.
+        """
+        if self.link_checker is None:
+            return
+        with self.stats.stage('check links'):
+            self.load_all_chapters()
+            expected_ids = {new_id for chapter, urls in self.ids.items() if chapter not in chapters
+                            for ids in urls.values() for new_id in ids.values()}
+            expected_ids.update(v['new_id'] for key_idx, v in self.toc.items() if key_idx[0] not in chapters)
+            self.dangling_links = self.link_checker.get_dangling(expected_ids)
+        for chapter, links in sorted(self.dangling_links.items()):
+            targets = sorted(links)
+            _logger.warning('chapter %s: %s links to %s missing ids: %s%s', chapter, sum(links.values()),
+                            len(targets), ', '.join(targets[:10]), ', ...' if len(targets) > 10 else '')
 
-        self.html = soup.prettify()
+    @staticmethod
+    def get_chapter_filename(chapter: int) -> str:
+        return f'chapter-{chapter}.html'
+
+    def link_to_chapter_files(self, chapter: int or None, *soups: BeautifulSoup) -> None:
+        # '#new_id' links to ids of other chapters become 'chapter-<n>.html#new_id'
+        for soup in soups:
+            for tag in soup.find_all(lambda t: t.get('href', '').startswith('#')):
+                target = self.id_chapters.get(tag['href'][1:])
+                if target is not None and target != chapter:
+                    tag['href'] = f'{self.get_chapter_filename(target)}{tag["href"]}'
+
+    def save_chapters(self, chapters=None, directory='book', processes=1, manifest=True) -> list:
+        """
+        Write the book as one file per chapter, directory/chapter-<n>.html (relative to content.html),
+        with links to the other chapters pointing to their files, and directory/index.html
+        with the toc of the whole book, and return the chapters' filenames.
+        With manifest, directory/manifest.json lists every chapter's file and title and every
+        id's chapter, and directory/reader.html uses it to load the chapters on demand.
+        With processes > 1 every worker renders and writes its chapters' files.
+        """
+        chapters = list(chapters or self.chapters)
+        directory = Path(__file__).parent / directory
+        directory.mkdir(parents=True, exist_ok=True)
+        self.load_all_chapters()
+        self.id_chapters = dict()
+        for chapter, urls in self.ids.items():
+            for ids in urls.values():
+                for new_id in ids.values():
+                    self.id_chapters.setdefault(new_id, chapter)
+        for key_idx, v in self.toc.items():
+            self.id_chapters.setdefault(v['new_id'], key_idx[0])
+        self._begin_link_check(chapters)
+        self.output_dir = directory
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_render_worker,
+                                     initargs=(self,)) as executor:
+                for result in executor.map(_save_chapter_in_worker, chapters, [directory] * len(chapters)):
+                    self._merge_worker_result(result)
+        else:
+            for chapter in chapters:
+                self.save_chapter(chapter, directory)
+        self._end_link_check(chapters)
+        if self.search_index is not None:
+            self.search_index.save()
+
+        toc_soup = self.get_toc_html_from_dict(0)
+        self.link_to_chapter_files(None, toc_soup)
+        shell_start, shell_end = self.get_html_shell_parts()
+        save_html([shell_start, ''.join(element.decode(indent_level=2) for element in toc_soup.contents), shell_end],
+                  directory / 'index.html')
+        if (Path(__file__).parent / 'style.css').exists():
+            shutil.copyfile(Path(__file__).parent / 'style.css', directory / 'style.css')
+        if manifest:
+            with open(directory / 'manifest.json', 'w') as outfile:
+                json.dump({
+                    'index': 'index.html',
+                    'chapters': [{'chapter': chapter, 'file': self.get_chapter_filename(chapter),
+                                  'title': self.toc.get((chapter,), dict()).get('title')} for chapter in chapters],
+                    'ids': {new_id: chapter for new_id, chapter in self.id_chapters.items() if chapter in chapters}
+                }, outfile)
+            (directory / 'reader.html').write_text(READER_HTML, encoding='utf-8')
+        self.id_chapters = None
+        self.output_dir = None
+        return [self.get_chapter_filename(chapter) for chapter in chapters]
+
+    def save_chapter(self, chapter: int, directory: Path) -> None:
+        shell_start, shell_end = self.get_html_shell_parts()
+        save_html([shell_start, self.render_chapter(chapter), shell_end],
+                  directory / self.get_chapter_filename(chapter))
+
+    def export_chapter_pdf(self, chapter: int, directory: Path) -> (Path, dict):
+        """
+        Render chapter to directory/chapter-<n>-<hash>.pdf with WeasyPrint, unless the file
+        for the same html, style.css and WeasyPrint version is there from an earlier export.
+        Return its path and {'pages': number of pages, 'anchors': {id: page index}}.
+        """
+        _check_pdf_support()
+        shell_start, shell_end = self.get_html_shell_parts()
+        html = shell_start + self.render_chapter(chapter) + shell_end
+        css_path = Path(__file__).parent / 'style.css'
+        css = css_path.read_text(encoding='utf-8') if css_path.exists() else ''
+        digest = hashlib.sha256(f'{weasyprint.__version__}\n{css}\n{html}'.encode()).hexdigest()[:16]
+        pdf_path = directory / f'chapter-{chapter}-{digest}.pdf'
+        pages_path = pdf_path.with_suffix('.json')
+        if pdf_path.exists() and pages_path.exists():
+            self.stats.count('pdf_chapters_reused')
+            return pdf_path, json.loads(pages_path.read_text())
+        with self.stats.stage('pdf'):
+            document = weasyprint.HTML(string=html, base_url=str(Path(__file__).parent)).render()
+            anchors = dict()
+            for i, page in enumerate(document.pages):
+                for anchor in page.anchors:
+                    anchors.setdefault(anchor, i)
+            for old_path in directory.glob(f'chapter-{chapter}-*'):
+                old_path.unlink()
+            document.write_pdf(pdf_path)
+        pages = {'pages': len(document.pages), 'anchors': anchors}
+        pages_path.write_text(json.dumps(pages))
+        self.stats.count('pdf_chapters_rendered')
+        return pdf_path, pages
+
+    def export_pdf(self, chapters=None, filename='content.pdf', directory='pdf', processes=1) -> None:
+        """
+        Write the chapters (all by default) as one pdf: every chapter is rendered to its own pdf
+        in directory (relative to content.html), in a pool of processes with processes > 1,
+        and only when its html changed since the last export, then the parts are merged
+        with bookmarks for every toc entry.
+        """
+        _check_pdf_support()
+        chapters = list(chapters or self.chapters)
+        directory = Path(__file__).parent / directory
+        directory.mkdir(parents=True, exist_ok=True)
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_render_worker,
+                                     initargs=(self,)) as executor:
+                results = list()
+                for pdf_path, pages, report in executor.map(_export_chapter_pdf_in_worker, chapters,
+                                                            [directory] * len(chapters)):
+                    self.stats.merge(report)
+                    results.append((pdf_path, pages))
+        else:
+            results = [self.export_chapter_pdf(chapter, directory) for chapter in chapters]
+
+        with self.stats.stage('merge pdf'):
+            writer = pypdf.PdfWriter()
+            # {key_idx: outline item}, so that sections are nested under their parents
+            outline = dict()
+            offset = 0
+            for chapter, (pdf_path, pages) in zip(chapters, results):
+                writer.append(str(pdf_path), import_outline=False)
+                self.load_chapter(chapter)
+                for key_idx in self.toc_index.chapter(chapter):
+                    page = pages['anchors'].get(self.toc[key_idx]['new_id'])
+                    if page is None:
+                        continue
+                    parent = next((outline[key_idx[:i]] for i in range(len(key_idx) - 1, 0, -1)
+                                   if key_idx[:i] in outline), None)
+                    title = f'{".".join(map(str, key_idx))} {self.toc[key_idx]["title"]}'
+                    outline[key_idx] = writer.add_outline_item(title, offset + page, parent=parent)
+                offset += pages['pages']
+            with open(Path(__file__).parent / filename, 'wb') as outfile:
+                writer.write(outfile)
+
+    def get_html_shell_parts(self) -> (str, str):
+        # the prettified document before and after the chapters
+        soup, body = self.get_html_shell()
+        shell = soup.prettify()
+        body_end = shell.index(' </body>')
+        return shell[:body_end], shell[body_end:]
+
+    def build_pipeline(self, chapters=(6,), filename='content.html', queue_size=16, processes=1) -> None:
+        """
+        Write the book to filename, the same text as save_html(self.iter_full_html(chapters), filename),
+        with the stages overlapping instead of one after another:
+        self.workers threads download the pages of the chapters in order, at most queue_size pages
+        ahead of the parser, pages are parsed and chapters transformed in an executor thread
+        (or chapters in a pool of processes), at most queue_size chapters ahead of the writer,
+        which writes them in order as they come.
+        """
+        self._begin_link_check(chapters)
+        with self.stats.stage('build_pipeline'):
+            asyncio.run(self._run_pipeline(chapters, Path(__file__).parent / filename, queue_size, processes))
+        self._end_link_check(chapters)
+        if self.search_index is not None:
+            self.search_index.save()
+        if self.report_path:
+            self.save_report(chapters)
+
+    def _prepare_page(self, chapter: int, url: str) -> None:
+        # parse the page ahead of render_chapter, unless it will take the memoized fragment instead
+        if self.memoize and self.fragment_key(url, self.ids[chapter][url]) in self.fragments:
+            return
+        self.get_page_artifacts(url, self.parser_backend)
+
+    async def _run_pipeline(self, chapters: list, path: Path, queue_size: int, processes: int) -> None:
+        loop = asyncio.get_running_loop()
+        # (chapter, url, download) items, (chapter, None, None) when all pages of chapter were queued
+        pages = asyncio.Queue(queue_size)
+        # futures of the chapters' html, in order
+        rendered = asyncio.Queue(queue_size)
+        with contextlib.ExitStack() as stack:
+            fetch_executor = stack.enter_context(ThreadPoolExecutor(max(self.workers, 1)))
+            # a single thread does all the parsing and transforming, so the parser's state is never shared
+            transform_executor = stack.enter_context(ThreadPoolExecutor(1))
+            if processes > 1:
+                render_executor = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=processes, initializer=_init_render_worker, initargs=(self,)))
+
+            async def fetch() -> None:
+                for chapter in chapters:
+                    await loop.run_in_executor(transform_executor, self.load_chapter, chapter)
+                    for url in self.ids.get(chapter, dict()):
+                        await pages.put((chapter, url, loop.run_in_executor(fetch_executor, self.cache.get, url)))
+                    await pages.put((chapter, None, None))
+                await pages.put(None)
+
+            async def transform() -> None:
+                while True:
+                    item = await pages.get()
+                    if item is None:
+                        break
+                    chapter, url, download = item
+                    if url is not None:
+                        await download
+                        if processes <= 1:
+                            await loop.run_in_executor(transform_executor, self._prepare_page, chapter, url)
+                    elif processes > 1:
+                        await rendered.put(loop.run_in_executor(render_executor, _render_chapter_in_worker, chapter))
+                    else:
+                        await rendered.put(loop.run_in_executor(transform_executor, self.render_chapter, chapter))
+                await rendered.put(None)
+
+            async def write() -> None:
+                shell_start, shell_end = self.get_html_shell_parts()
+                with open(path, 'w', encoding='utf-8') as outfile:
+                    outfile.write(shell_start)
+                    while True:
+                        future = await rendered.get()
+                        if future is None:
+                            break
+                        chapter_html = await future
+                        if processes > 1:
+                            chapter_html = self._merge_worker_result(chapter_html)
+                        outfile.write(chapter_html)
+                    outfile.write(shell_end)
+
+            await asyncio.gather(fetch(), transform(), write())
+
+    def get_full_html(self, chapters=(6,), processes=1) -> None:
+        with self.stats.stage('get_full_html'):
+            self.html = ''.join(self.iter_full_html(chapters, processes))
+        if self.report_path:
+            self.save_report(chapters)
+
+    def save_full_html(self, chapters=(6,), filename='content.html', processes=1) -> None:
+        # like get_full_html, but written to filename as it is rendered instead of kept in self.html
+        with self.stats.stage('get_full_html'):
+            save_html(self.iter_full_html(chapters, processes), filename)
+        if self.report_path:
+            self.save_report(chapters)
+
+    def save_report(self, chapters: list) -> None:
+        report = self.stats.report()
+        report['chapters'] = list(chapters)
+        report['dangling_links'] = self.dangling_links
+        with open(self.report_path, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+
+
+# the Parser of a chapter rendering worker process
+_worker_parser = None
+
+
+def _init_render_worker(parser: Parser) -> None:
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _render_chapter_in_worker(chapter: int) -> (str, dict, SearchIndex or None, LinkChecker or None):
+    # a forked worker shares the parent's counters, index and links, collect this chapter's only
+    _worker_parser.stats = BuildStats()
+    _worker_parser.cache.stats = _worker_parser.stats
+    if _worker_parser.search_index is not None:
+        _worker_parser.search_index = SearchIndex(_worker_parser.search_index.directory)
+    if _worker_parser.link_checker is not None:
+        _worker_parser.link_checker = LinkChecker()
+    chapter_html = _worker_parser.render_chapter(chapter)
+    return chapter_html, _worker_parser.stats.report(), _worker_parser.search_index, _worker_parser.link_checker
+
+
+def _save_chapter_in_worker(chapter: int, directory: Path) -> (str, dict, SearchIndex or None, LinkChecker or None):
+    chapter_html, report, search_index, link_checker = _render_chapter_in_worker(chapter)
+    shell_start, shell_end = _worker_parser.get_html_shell_parts()
+    save_html([shell_start, chapter_html, shell_end], directory / _worker_parser.get_chapter_filename(chapter))
+    return '', report, search_index, link_checker
+
+
+def _export_chapter_pdf_in_worker(chapter: int, directory: Path) -> (Path, dict, dict):
+    _worker_parser.stats = BuildStats()
+    _worker_parser.cache.stats = _worker_parser.stats
+    pdf_path, pages = _worker_parser.export_chapter_pdf(chapter, directory)
+    return pdf_path, pages, _worker_parser.stats.report()
 
 
 # def get_urls_from_main_page() -> dict:
@@ -797,11 +2962,18 @@ class Parser:
 #     return soup.prettify()
 #
 #
-def save_html(html: str, filename='content.html') -> None:
+def save_html(html, filename='content.html') -> None:
+    """
+    html is either the whole document or an iterable of its pieces,
+    e.g. Parser.iter_full_html(), written out as they come.
+    """
     dir_path = Path(__file__).parent
     html_filepath = dir_path / filename
+    if isinstance(html, str):
+        html = [html]
     with open(html_filepath, 'w', encoding="utf-8") as f:
-        f.write(html)
+        for chunk in html:
+            f.write(chunk)
 
 
 # def save_toc_dict_as_json():
@@ -817,9 +2989,113 @@ def save_html(html: str, filename='content.html') -> None:
 #     return toc_dict
 
 
+def build_targets(main_page_urls: list, chapters=None, cache=None, from_json=None, search=False, **kwargs) -> dict:
+    """
+    Build the book of every docs site (e.g. every release) in main_page_urls
+    in one process and return {main_page_url: html filename}.
+    The sites share the page cache, which stores every distinct body once,
+    the pages parsed by their content and the memoized fragments, which leave the site's url out,
+    so a page that is identical in several releases is stored, parsed and transformed once.
+    All sites are read or crawled before any is rendered, so that the crawls share the parsed pages,
+    which are freed chapter by chapter as the books are rendered.
+    DOCS_MAIN_PAGE keeps its data in data/, other sites in data/<target name>/,
+    with search, the search index of each goes to search-<target name>/.
+    from_json=None reads the data of a site that has data/.../urls.json
+    and crawls the others, True or False applies to every site.
+    chapters defaults to all chapters of each site, kwargs go to Parser.
+    """
+    cache = cache or PageCache()
+    # {sha256 of the page: PageArtifacts} of all sites
+    parsed_pages = dict()
+    parsers = dict()
+    for main_page_url in main_page_urls:
+        name = target_name(main_page_url)
+        data_dir = Path(__file__).parent / 'data'
+        if main_page_url != DOCS_MAIN_PAGE:
+            data_dir = data_dir / name
+        data_dir.mkdir(parents=True, exist_ok=True)
+        _logger.info('reading %s', main_page_url)
+        site_from_json = (data_dir / 'urls.json').exists() if from_json is None else from_json
+        parsers[main_page_url] = Parser(from_json=site_from_json, cache=cache, main_page_url=main_page_url,
+                                        data_dir=data_dir, parsed_pages=parsed_pages,
+                                        search_dir=f'search-{name}' if search else None, **kwargs)
+    filenames = dict()
+    for main_page_url, parser in parsers.items():
+        _logger.info('building %s', main_page_url)
+        filenames[main_page_url] = f'content-{target_name(main_page_url)}.html'
+        save_html(parser.iter_full_html(chapters or parser.chapters), filenames[main_page_url])
+        parser.pages.clear()
+    return filenames
+
+
 def main():
-    p = Parser(from_json=True)
-    p.get_full_html()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--convert-store', action='store_true',
+                            help='build data/store.sqlite from the json files in data/ and exit')
+    arg_parser.add_argument('--report', metavar='PATH', help='write stage timings and counters as json to PATH')
+    arg_parser.add_argument('--profile', action='store_true', help='add a cProfile summary to the report')
+    arg_parser.add_argument('--trace-memory', action='store_true', help='add the tracemalloc peak to the report')
+    arg_parser.add_argument('--targets', metavar='URL', nargs='+',
+                            help='build content-<name>.html for each of these docs sites (main page urls)')
+    arg_parser.add_argument('--chapters', type=int, nargs='+',
+                            help='chapters of the --targets, --split, --pdf and --epub books (default all) '
+                                 'or of content.html and --pipeline (default 6)')
+    arg_parser.add_argument('--pipeline', action='store_true',
+                            help='write content.html with downloading, parsing and writing overlapping')
+    arg_parser.add_argument('--search', metavar='QUERY',
+                            help='print the sections of the built book matching QUERY ("..." for a phrase) and exit')
+    arg_parser.add_argument('--build-search', action='store_true',
+                            help='build the search index (of every target with --targets) along with the book')
+    arg_parser.add_argument('--search-dir', default='search', help='search index directory, next to content.html')
+    arg_parser.add_argument('--split', metavar='DIR',
+                            help='write one file per chapter (--chapters, default all) to DIR instead, and exit')
+    arg_parser.add_argument('--pdf', metavar='FILE',
+                            help='export the chapters (--chapters, default all) as one pdf to FILE and exit')
+    arg_parser.add_argument('--epub', metavar='FILE',
+                            help='export the chapters (--chapters, default all) as an epub book to FILE and exit')
+    arg_parser.add_argument('--processes', type=int, default=1, help='chapters rendered in parallel')
+    arg_parser.add_argument('--workers', type=int,
+                            help='pages downloaded in parallel (default 1, or 8 with --pipeline)')
+    arg_parser.add_argument('--assets-dir', metavar='DIR',
+                            help='download the images into DIR, next to content.html, and link to the local copies')
+    arg_parser.add_argument('--inline-images-below', metavar='BYTES', type=int, default=0,
+                            help='with --assets-dir, embed images up to BYTES as data URIs')
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help='refetch and recompute only the pages that changed upstream')
+    arg_parser.add_argument('--discover', action='store_true',
+                            help='with --incremental, find the changed pages from objects.inv and sitemap.xml')
+    args = arg_parser.parse_args()
+    options = dict(workers=args.workers or (8 if args.pipeline else 1), assets_dir=args.assets_dir,
+                   inline_images_below=args.inline_images_below)
+    search_dir = args.search_dir if args.build_search else None
+    if args.search:
+        for new_id, title, score in SearchIndex.load(Path(__file__).parent / args.search_dir).search(args.search):
+            print(f'{score:>5}  content.html#{new_id}  {title}')
+        return
+    if args.convert_store:
+        Parser(from_json=True).convert_json_to_store()
+        return
+    if args.targets:
+        build_targets(args.targets, args.chapters, search=args.build_search, **options)
+        return
+    if args.pdf:
+        Parser(from_json=True, **options).export_pdf(args.chapters, args.pdf, processes=args.processes)
+        return
+    if args.epub:
+        Parser(from_json=True, **options).export_epub(args.chapters, args.epub)
+        return
+    if args.split:
+        Parser(from_json=True, search_dir=search_dir, **options).save_chapters(
+            args.chapters, args.split, args.processes)
+        return
+    if args.pipeline:
+        Parser(from_json=True, search_dir=search_dir, **options).build_pipeline(args.chapters or (6,))
+        return
+
+    p = Parser(from_json=True, stats=BuildStats(profile=args.profile, trace_memory=args.trace_memory),
+               report_path=args.report, search_dir=search_dir, incremental=args.incremental,
+               discover=args.discover, **options)
+    p.save_full_html(args.chapters or (6,), processes=args.processes)
 
     # save_toc_dict_as_json()
     # toc_dict = get_toc_dict_from_json()
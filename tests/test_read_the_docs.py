@@ -0,0 +1,137 @@
+import functools
+import http.server
+import json
+import logging
+import threading
+import urllib.error
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup
+
+from read_the_docs import Parser, PageCache, DOCS_MAIN_PAGE
+
+SECTION = """<div class="section" id="front-label-section">
+<span id="front-label"></span><h1>Front<a class="headerlink" href="#front-label" title="Permalink">¶</a></h1>
+<p>See <a href="#front-label">the label</a>.</p>
+</div>"""
+
+
+def rewrite_one_by_one(soup: BeautifulSoup, id_map: dict, url: str) -> BeautifulSoup:
+    # the steps rewrite_section replaces, applied the way the build used to
+    soup = Parser.lower_headings(soup)
+    for old_id, new_id in id_map.items():
+        soup = Parser.replace_id(soup, old_id, new_id)
+    soup = Parser.replace_img_sources(soup)
+    return Parser.clean_hrefs(soup, url)
+
+
+def test_rewrite_section_gives_the_none_id_to_the_first_tag_without_an_id():
+    url = f'{DOCS_MAIN_PAGE}/front/index.html'
+    # None comes from toc entries without an anchor, as in a crawl or the store
+    id_map = {'': 'front-index', 'front-label-section': 'front-index-front-label-section',
+              'front-label': 'front-index-front-label', None: 'front-index'}
+    expected = rewrite_one_by_one(BeautifulSoup(SECTION, 'html.parser').div, id_map, url)
+    section = Parser.rewrite_section(BeautifulSoup(SECTION, 'html.parser').div, id_map, url)
+    assert str(section) == str(expected)
+    assert section.find('span')['id'] == 'front-index-front-label'
+    assert section.find('h2')['id'] == 'front-index'
+
+
+# chapter: [(page, [(section number, id, title)])]
+SITE = {
+    1: [('start/index.html', [('1', 'start', 'Getting Started')]),
+        ('start/studio.html', [('1.1', 'studio', 'Using Studio'), ('1.1.1', 'studio-login', 'Logging In')])],
+    2: [('course/index.html', [('2', 'course', 'Building a Course')]),
+        ('course/outline.html', [('2.1', 'outline', 'The Outline'), ('2.1.1', 'sections', 'Sections'),
+                                 ('2.1.2', 'units', 'Units')]),
+        ('course/grading.html', [('2.2', 'grading', 'Grading')])],
+}
+
+
+def make_site(directory: Path) -> None:
+    menu = list()
+    for chapter, pages in SITE.items():
+        for filename, sections in pages:
+            body = ''
+            for number, old_id, title in reversed(sections):
+                level = number.count('.') + 1
+                body = (f'<section id="{old_id}"><h{level}><span class="section-number">{number}. </span>{title}'
+                        f'<a class="headerlink" href="#{old_id}">¶</a></h{level}>'
+                        f'<p>About {title.lower()}, see <a class="reference internal" href="../start/index.html">'
+                        f'the start</a>.</p>{body}</section>')
+                if level <= 2:
+                    menu.append(f'<li class="toctree-l{level}"><a class="reference internal" '
+                                f'href="{filename}{f"#{old_id}" if number.count(".") else ""}">{number}. {title}</a></li>')
+            path = directory / filename
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(f'<html><body><div role="main">{body}</div></body></html>', encoding='utf-8')
+    (directory / 'index.html').write_text(
+        f'<html><body><div class="wy-menu wy-menu-vertical"><ul>{"".join(menu)}</ul></div>'
+        f'<section id="welcome"><h1>Fixture Docs<a class="headerlink" href="#welcome">¶</a></h1></section>'
+        f'</body></html>', encoding='utf-8')
+
+
+class SiteHandler(http.server.SimpleHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path in self.server.failing:
+            self.send_error(503)
+            return
+        super().do_GET()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def site(tmp_path):
+    """
+    The url of a local stand-in for the docs site, and the set of paths it answers with 503.
+    """
+    make_site(tmp_path / 'site')
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             functools.partial(SiteHandler, directory=str(tmp_path / 'site')))
+    server.failing = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}', server.failing
+    server.shutdown()
+    server.server_close()
+
+
+def crawl(tmp_path: Path, mirror: str, name: str, **kwargs) -> Parser:
+    return Parser(from_json=False, cache=PageCache(tmp_path / name / 'cache', retries=0, mirror=mirror),
+                  data_dir=tmp_path / name / 'data', **kwargs)
+
+
+def test_concurrent_crawl_matches_serial_crawl(tmp_path, site):
+    mirror, _ = site
+    serial = crawl(tmp_path, mirror, 'serial', workers=1)
+    concurrent = crawl(tmp_path, mirror, 'concurrent', workers=4)
+    assert serial.urls == concurrent.urls and list(serial.urls[2]) == [
+        f'{DOCS_MAIN_PAGE}/{filename}' for filename, _ in SITE[2]]
+    assert serial.ids == concurrent.ids
+    assert list(serial.toc.items()) == list(concurrent.toc.items())
+    for name in ('urls.json', 'ids.json', 'toc.json'):
+        assert (tmp_path / 'serial' / 'data' / name).read_text() == (tmp_path / 'concurrent' / 'data' / name).read_text()
+    serial.get_full_html(serial.chapters)
+    concurrent.get_full_html(concurrent.chapters)
+    assert serial.html == concurrent.html
+    assert 'Fixture Docs' in serial.html and 'Units' in serial.html
+
+
+def test_interrupted_crawl_resumes_from_the_checkpoint(tmp_path, site, caplog):
+    mirror, failing = site
+    crawl(tmp_path, mirror, 'full')
+    # the crawl stops at the last page, after checkpointing every page before it
+    failing.add('/course/grading.html')
+    with pytest.raises(urllib.error.HTTPError):
+        crawl(tmp_path, mirror, 'resumed', checkpoint_every=1)
+    checkpoint = json.loads((tmp_path / 'resumed' / 'data' / 'crawl_checkpoint.json').read_text())
+    assert len(checkpoint['crawled']['get_ids']) == 4
+    failing.clear()
+    with caplog.at_level(logging.INFO):
+        crawl(tmp_path, mirror, 'resumed')
+    assert "resuming the crawl" in caplog.text and "{'get_ids': 4, 'get_toc': 0}" in caplog.text
+    assert not (tmp_path / 'resumed' / 'data' / 'crawl_checkpoint.json').exists()
+    for name in ('urls.json', 'ids.json', 'toc.json'):
+        assert (tmp_path / 'full' / 'data' / name).read_text() == (tmp_path / 'resumed' / 'data' / name).read_text()